@@ -0,0 +1,27 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Fixtures shared by the test modules
+"""
+
+import glob
+import os.path as osp
+
+import pytest
+
+from voice_lock.pipeline import make_pipeline
+from voice_lock.verify import DATA_DIR, find_ref_samples, make_cipher
+from voice_lock.wave_proc import make_enc_wave, read_wav
+
+TEST_WAVS = sorted(glob.glob(osp.join(DATA_DIR, 'test_samples', '*.wav')))
+
+@pytest.fixture(scope='session')
+def templates():
+    '''Block envelopes of the bundled references and test clips'''
+    cipher = make_cipher()
+    pipeline = make_pipeline('block')
+    refs = [make_enc_wave(path, cipher, pipeline) for path in find_ref_samples()]
+    tests = [pipeline(read_wav(path)) for path in TEST_WAVS]
+    return refs, tests
@@ -0,0 +1,34 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Agreement of the min-sum kernel backends on the bundled samples.
+
+Run with: python -m pytest tests
+"""
+
+import glob
+import os.path as osp
+
+import pytest
+
+from voice_lock.backends import available_backends
+from voice_lock.verify import DATA_DIR, find_ref_samples, make_cipher
+from voice_lock.wave_proc import corr_tuple, make_enc_wave, make_wave
+
+@pytest.fixture(scope='module')
+def pair():
+    test_path = sorted(glob.glob(osp.join(DATA_DIR, 'test_samples', '*.wav')))[0]
+    return make_wave(test_path), make_enc_wave(find_ref_samples()[0], make_cipher())
+
+@pytest.fixture(scope='module')
+def reference_score(pair):
+    return corr_tuple(*pair, metric='minsum', backend='python')
+
+@pytest.mark.parametrize('backend', ['numpy', 'numba'])
+def test_backend_matches_python(pair, reference_score, backend):
+    if backend not in available_backends():
+        pytest.skip(f'{backend} does not import on this host')
+    score = corr_tuple(*pair, metric='minsum', backend=backend)
+    assert score == pytest.approx(reference_score, abs=1e-9)
@@ -0,0 +1,39 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Batched preprocessing against clip-by-clip pipelines.
+
+Run with: python -m pytest tests
+"""
+
+import glob
+import os.path as osp
+
+import numpy as np
+import pytest
+
+from voice_lock.pipeline import ENVELOPES, make_pipeline, process_batch
+from voice_lock.verify import DATA_DIR
+from voice_lock.wave_proc import read_wav
+
+@pytest.fixture(scope='module')
+def clips():
+    paths = sorted(glob.glob(osp.join(DATA_DIR, 'test_samples', '*.wav')))
+    return [read_wav(path) for path in paths]
+
+@pytest.mark.parametrize('engine', sorted(ENVELOPES))
+def test_process_batch_matches_single(clips, engine):
+    # Edge cases: one sample, short and float32 clips, no positive samples
+    clips = clips + [clips[0][:1], clips[1][:5000], clips[2][:7000].astype(np.float32),
+                     -np.abs(clips[3][:3000])]
+    pipeline = make_pipeline(engine)
+    expected = [tuple(np.copy(channel) for channel in pipeline(data)) for data in clips]
+    actual = process_batch(clips, pipeline)
+    assert len(actual) == len(expected)
+    for template, reference in zip(actual, expected):
+        assert len(template) == len(reference)
+        for channel, channel_ref in zip(template, reference):
+            assert len(channel) == len(channel_ref)
+            np.testing.assert_allclose(channel, channel_ref, rtol=1e-9, atol=1e-12)
@@ -0,0 +1,28 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Pruned exact shift search of the min-sum metric against `corr`.
+
+Run with: python -m pytest tests
+"""
+
+import numpy as np
+
+from voice_lock.wave_proc import corr, corr_pruned
+
+def test_corr_pruned_matches_corr():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        wave1 = rng.random(rng.integers(1, 80))
+        wave2 = rng.random(rng.integers(1, 80)) * rng.choice([1.0, -1.0])
+        block = int(rng.integers(1, 20))
+        for seed in ('centroid', 'zero'):
+            assert corr_pruned(wave1, wave2, seed=seed, block=block) == corr(wave1, wave2)
+
+def test_corr_pruned_prunes(templates):
+    refs, tests = templates
+    stats = {}
+    assert corr_pruned(refs[0][0], tests[0][0], stats=stats) == corr(refs[0][0], tests[0][0])
+    assert 0 < stats['pruned'] < stats['shifts']
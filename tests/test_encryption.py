@@ -0,0 +1,56 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Incremental encryption of a sample directory.
+
+Run with: python -m pytest tests
+"""
+
+import os
+import os.path as osp
+
+import numpy as np
+import scipy.io.wavfile as siw
+
+from voice_lock.aes_cipher import AESCipher
+from voice_lock.wave_proc import encrypt_wavs
+
+KEY = b'Sixteen byte key'
+
+def _write_samples(dir_in, count, seed=0):
+    rng = np.random.default_rng(seed)
+    for k in range(count):
+        siw.write(osp.join(dir_in, f'{k}.wav'), 8000, rng.integers(-2**15, 2**15, 4000, np.int16))
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_encrypt_wavs_skips_reencrypts_and_round_trips(tmp_path):
+    dir_in, dir_out = str(tmp_path / 'raw'), str(tmp_path / 'enc')
+    os.makedirs(dir_in)
+    os.makedirs(dir_out)
+    _write_samples(dir_in, 3)
+
+    report = encrypt_wavs(dir_in, dir_out, AESCipher(key=KEY), incremental=True)
+    assert (report['encrypted'], report['skipped']) == (3, 0)
+    first = {name: _read(osp.join(dir_out, f'{name}.enc')) for name in os.listdir(dir_in)}
+    # Every file is encrypted under its own init vector
+    assert len({data[:16] for data in first.values()}) == 3
+
+    report = encrypt_wavs(dir_in, dir_out, AESCipher(key=KEY), incremental=True)
+    assert (report['encrypted'], report['skipped']) == (0, 3)
+
+    _write_samples(dir_in, 1, seed=1)  # changes 0.wav
+    report = encrypt_wavs(dir_in, dir_out, AESCipher(key=KEY), incremental=True)
+    assert (report['encrypted'], report['skipped']) == (1, 2)
+    assert _read(osp.join(dir_out, '1.wav.enc')) == first['1.wav']
+    assert _read(osp.join(dir_out, '0.wav.enc')) != first['0.wav']
+
+    # Outputs decrypt with a cipher loaded the way the application loads it
+    cipher = AESCipher(key=KEY)
+    cipher.load_iv(osp.join(dir_out, 'iv'))
+    for name in os.listdir(dir_in):
+        assert cipher.load_data(osp.join(dir_out, f'{name}.enc')) == _read(osp.join(dir_in, name))
@@ -0,0 +1,86 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Equivalence of the optimized code paths with the reference implementations.
+
+Run with: python -m pytest tests
+"""
+
+import glob
+import math as m
+import os.path as osp
+
+import numpy as np
+import pytest
+
+from voice_lock.consolidate import consolidate, load_consolidation
+from voice_lock.pipeline import make_pipeline
+from voice_lock.template_cache import TemplateCache
+from voice_lock.verify import DATA_DIR, find_ref_samples, make_cipher
+from voice_lock.wave_proc import (denoise, envelope, get_wave_data, make_enc_wave, make_pyramid,
+                                  normalize, read_wav)
+
+TEST_WAVS = sorted(glob.glob(osp.join(DATA_DIR, 'test_samples', '*.wav')))
+
+### ~~~ Reference DSP ~~~ ###
+# The original sample-by-sample preprocessing, which the pipeline replaced
+
+def reference_template(data):
+    wave = np.asarray(data)
+    if wave.ndim == 2:
+        wave = wave.mean(1)
+    wave = wave / np.amax(wave)
+    for i in range(len(wave)):
+        wave[i] = (wave[i] - 0.9 * wave[i - 1]) * (0.54 - 0.46 * m.cos((i - 6) * 2 * m.pi / 180))
+    plus = [elm for elm in wave if elm >= 0]
+    minus = [abs(elm) for elm in wave if elm < 0]
+    return tuple([np.mean(part[i:i + 75]) for i in range(0, len(part) - len(part) % 75, 75)]
+                 for part in (plus, minus))
+
+### ~~~ Tests ~~~ ###
+
+@pytest.mark.parametrize('path', TEST_WAVS, ids=osp.basename)
+def test_pipeline_matches_reference(path):
+    data = read_wav(path)
+    expected = reference_template(data)
+    actual = make_pipeline('block')(data)
+    # float32 clips are processed in float32 by the reference loops
+    tol = 1e-5 if data.dtype == np.float32 else 1e-9
+    for channel, reference in zip(actual, expected):
+        assert len(channel) == len(reference)
+        np.testing.assert_allclose(channel, reference, rtol=tol, atol=tol)
+
+@pytest.mark.parametrize('path', TEST_WAVS, ids=osp.basename)
+def test_stage_functions_match_reference(path):
+    data = read_wav(path)
+    expected = reference_template(data)
+    actual = envelope(denoise(normalize(get_wave_data(path))))
+    tol = 1e-5 if data.dtype == np.float32 else 1e-9
+    for channel, reference in zip(actual, expected):
+        assert len(channel) == len(reference)
+        np.testing.assert_allclose(channel, reference, rtol=tol, atol=tol)
+
+def test_stored_consolidation_matches_fresh(templates, tmp_path):
+    refs, _ = templates
+    cipher = make_cipher()
+    path = str(tmp_path / 'medoids.enc')
+    fresh = consolidate(refs)
+    for _ in range(2):  # computed and stored, then loaded
+        stored = load_consolidation(path, refs, cipher)
+        assert (stored.medoids, stored.members) == (fresh.medoids, fresh.members)
+    # Other templates invalidate the stored clusters
+    assert load_consolidation(path, refs[:3], cipher).members == consolidate(refs[:3]).members
+
+def test_pinned_templates_match_single_loads():
+    cipher = make_cipher()
+    paths = find_ref_samples()
+    cache = TemplateCache(cipher)
+    cache.add_speaker('Master', paths)
+    cache.pin('Master')
+    assert cache.stats()['misses'] == len(paths)
+    for path, template in zip(paths, cache.templates('Master')):
+        for channel, reference in zip(template, make_pyramid(make_enc_wave(path, cipher))):
+            np.testing.assert_array_equal(channel, reference)
+    assert cache.stats()['hits'] == len(paths)
@@ -0,0 +1,20 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Coarse-to-fine shift search against the exhaustive `corr`.
+
+Run with: python -m pytest tests
+"""
+
+import pytest
+
+from voice_lock.wave_proc import corr, corr_pyramid, make_pyramid
+
+def test_pyramid_finds_exhaustive_peak(templates):
+    refs, tests = templates
+    for test in tests:
+        for ref in refs:
+            for wave1, wave2 in zip(make_pyramid(test), make_pyramid(ref)):
+                assert corr_pyramid(wave1, wave2) == pytest.approx(corr(wave1, wave2), abs=1e-9)
@@ -0,0 +1,69 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Invalidation and persistence of the score cache.
+
+Run with: python -m pytest tests
+"""
+
+import json
+
+import numpy as np
+import pytest
+
+from voice_lock.aes_cipher import AESCipher
+from voice_lock.score_cache import ScoreCache
+from voice_lock.wave_proc import PIPELINE, corr_tuple
+
+@pytest.fixture
+def pair():
+    rng = np.random.default_rng(0)
+    return tuple(rng.random(60) for _ in range(2)), tuple(rng.random(50) for _ in range(2))
+
+@pytest.fixture
+def cipher():
+    return AESCipher(key=b'Sixteen byte key')
+
+def test_changed_settings_metric_or_params_miss(pair, tmp_path, cipher):
+    test, ref = pair
+    cache = ScoreCache(cache_dir=str(tmp_path), cipher=cipher)
+    cache.score(test, ref, 'minsum-pruned')
+
+    cache.score(test, ref, 'ncc')
+    cache.score(test, ref, 'minsum-pruned', block=8)
+    assert cache.stats()['misses'] == 3
+
+    # Same directory, but templates made by another pipeline version
+    changed = ScoreCache(cache_dir=str(tmp_path), cipher=cipher,
+                         settings=dict(PIPELINE, version=PIPELINE['version'] + 1))
+    changed.score(test, ref, 'minsum-pruned')
+    assert changed.stats() == {'entries': 1, 'hits': 0, 'disk_hits': 0, 'misses': 1}
+
+def test_disk_entry_survives_new_cache(pair, tmp_path, cipher):
+    test, ref = pair
+    score = ScoreCache(cache_dir=str(tmp_path), cipher=cipher).score(test, ref)
+
+    reopened = ScoreCache(cache_dir=str(tmp_path), cipher=AESCipher(key=b'Sixteen byte key'))
+    assert reopened.score(test, ref) == score
+    assert reopened.stats()['disk_hits'] == 1
+
+def test_foreign_entries_are_rescored(pair, tmp_path, cipher):
+    test, ref = pair
+    exact = corr_tuple(test, ref)
+
+    # Entry encrypted with another key
+    ScoreCache(cache_dir=str(tmp_path), cipher=AESCipher(key=b'Another 16B key!')).score(test, ref)
+    cache = ScoreCache(cache_dir=str(tmp_path), cipher=cipher)
+    assert cache.score(test, ref) == exact
+    assert cache.stats()['disk_hits'] == 0
+
+    # Entry stored under the file name of another key
+    cache = ScoreCache(cache_dir=str(tmp_path), cipher=cipher)
+    key = cache.key(test, ref)
+    data = cipher.encrypt(json.dumps({'key': 'other', 'score': 123.0}).encode())
+    with open(cache._path(key), 'wb') as f:
+        f.write(data)
+    assert cache.score(test, ref) == exact
+    assert cache.stats()['disk_hits'] == 0
@@ -0,0 +1,26 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Scoring against a reference bank republished in shared memory.
+
+Run with: python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+from voice_lock.shared_bank import ParallelScorer, SharedBank
+from voice_lock.wave_proc import corr_tuple
+
+def test_scores_follow_republished_bank():
+    rng = np.random.default_rng(0)
+    refs = [(rng.random(50), rng.random(50)) for _ in range(5)]
+    test = (rng.random(50), rng.random(50))
+
+    with SharedBank() as bank, ParallelScorer(bank, workers=2) as scorer:
+        for published in (refs, refs[:2], []):
+            bank.publish(published)
+            expected = np.mean([corr_tuple(test, ref, 'ncc') for ref in published] or [0.0])
+            assert scorer.score(test, 'ncc') == pytest.approx(expected)
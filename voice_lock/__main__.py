@@ -6,18 +6,133 @@
 voice_lock - cryptograhic biometric authorisation tool
 """
 
+import argparse
 import sys
-from PyQt5 import QtCore, QtWidgets, QtGui
-from .main_window import MainWindow
 
-def main():
+from .wave_proc import METRICS
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='voice_lock', description=__doc__)
+    parser.add_argument('--metric', choices=sorted(METRICS), default='minsum',
+                        help='similarity metric used for comparison')
+    parser.add_argument('--envelope', choices=('block', 'hilbert'), default='block',
+                        help='envelope engine: sign-split block means or Hilbert magnitude')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='classification cut-off (default depends on metric)')
+    parser.add_argument('--backend', default=None,
+                        help="min-sum kernel: python, numpy, numba or auto "
+                             "(default: $VOICE_LOCK_BACKEND or auto)")
+    parser.add_argument('--cache-mb', type=float, default=64,
+                        help='memory budget of the reference template cache in MB')
+    parser.add_argument('--quantize', type=int, choices=(8, 16), default=None, metavar='BITS',
+                        help='keep reference templates quantized to 8 or 16 bits')
+    parser.add_argument('--full-bank', action='store_true',
+                        help='score every reference instead of their medoids first')
+    parser.add_argument('--score-cache', metavar='DIR', default=None,
+                        help='keep encrypted comparison scores in DIR between runs')
+    parser.add_argument('--verify', metavar='WAV', default=None,
+                        help='verify WAV file against the references without GUI')
+    parser.add_argument('--scan', metavar='WAV', default=None,
+                        help='find the reference phrase in a long WAV recording')
+    parser.add_argument('--deadline', type=float, metavar='SECONDS', default=None,
+                        help='answer within SECONDS using the best fidelity reached by then')
+    parser.add_argument('--profile', metavar='DIR', default=None,
+                        help='profile the run, writing cProfile stats and collapsed stacks to DIR')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='with --profile, also record allocation hot spots')
+    return parser.parse_args(argv)
+
+def verify(args):
+    from .verify import verify_file
+
+    if args.deadline is not None:
+        return verify_deadline(args)
+
+    conf, accepted = verify_file(args.verify, metric=args.metric, threshold=args.threshold,
+                                 score_cache_dir=args.score_cache, quantize_bits=args.quantize,
+                                 consolidate_refs=not args.full_bank)
+    print(f'Confidence is {conf}')
+    print('Greetings, Master' if accepted else 'You are not Master to me.')
+    return 0 if accepted else 1
+
+def verify_deadline(args):
+    import time
+    from .deadline import verify_with_deadline, warm_up
+    from .verify import REFS_PATH, load_ref_consolidation, load_ref_samples, make_cipher
+    from .wave_proc import make_wave
+
+    cipher = make_cipher()
+    ref_samples = load_ref_samples(REFS_PATH, cipher, args.quantize)
+    test_sample = make_wave(args.verify)
+
+    # Medoids are stored with the references, but clustering them again
+    # after the references changed counts against the deadline too
+    warm_up(args.metric)
+    start = time.monotonic()
+    subset = None
+    if not args.full_bank:
+        subset = load_ref_consolidation(ref_samples, cipher, quantize_bits=args.quantize).medoids
+    result = verify_with_deadline(test_sample, ref_samples, args.deadline,
+                                  metric=args.metric, threshold=args.threshold, subset=subset,
+                                  start=start)
+    print(f'Confidence is {result.confidence} at fidelity {result.level} '
+          f'of {", ".join(result.levels)} in {result.seconds * 1e3:.1f} ms'
+          + (' (cut short by deadline)' if result.cut_short else ''))
+    print('Greetings, Master' if result.accepted else 'You are not Master to me.')
+    return 0 if result.accepted else 1
+
+def scan(args):
+    from .spotting import SCAN_THRESHOLD, spot_file
+    from .verify import find_ref_samples, make_cipher
+
+    threshold = SCAN_THRESHOLD if args.threshold is None else args.threshold
+    matches = spot_file(args.scan, find_ref_samples(), make_cipher(), threshold=threshold)
+    for match in matches:
+        print(f'{match.offset:10.2f} s  score {match.score:.3f}  reference #{match.ref_index}')
+    print(f'{len(matches)} candidate matches found')
+    return 0 if matches else 1
+
+def run(args):
+    from .pipeline import set_envelope_engine
+    set_envelope_engine(args.envelope)
+
+    if args.backend is not None:
+        from .backends import select_backend
+        select_backend(args.backend)
+
+    if args.verify is not None:
+        return verify(args)
+    if args.scan is not None:
+        return scan(args)
+
+    from PyQt5 import QtWidgets
+    from .main_window import MainWindow
+
     # Create and configure application window
     app = QtWidgets.QApplication(sys.argv)
     app.setStyle("fusion")  # Linux visual style
-    window = MainWindow()
+    window = MainWindow(metric=args.metric, threshold=args.threshold,
+                        cache_budget=int(args.cache_mb * 2**20),
+                        score_cache_dir=args.score_cache, quantize_bits=args.quantize,
+                        consolidate_refs=not args.full_bank, deadline=args.deadline)
     window.show()
 
-    sys.exit(app.exec_())
+    return app.exec_()
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile is None:
+        sys.exit(run(args))
+
+    from .profiling import Profiler
+
+    profiler = Profiler(args.profile, memory=args.profile_memory).start()
+    try:
+        code = run(args)
+    finally:
+        for path in profiler.stop():
+            print(f'Profile written to {path}')
+    sys.exit(code)
 
 if __name__ == "__main__":
 
@@ -4,6 +4,10 @@ from Crypto import Random
 from Crypto.Cipher import AES
 from copy import deepcopy
 
+def random_iv():
+    '''Fresh random init vector'''
+    return Random.new().read(AES.block_size)
+
 class AESCipher(object):
     '''Class for easy AES cryptography'''
 
@@ -11,7 +15,7 @@ class AESCipher(object):
         self.key = hashlib.sha256(key).digest()
 
         if iv is None:
-            self.iv = Random.new().read(AES.block_size)
+            self.iv = random_iv()
         else:
             self.iv = iv
 
@@ -30,7 +34,8 @@ class AESCipher(object):
         return self.iv + _cipher.encrypt(raw)
 
     def decrypt(self, enc):
-        _cipher = AES.new(self.key, AES.MODE_CFB, self.iv)
+        '''Decrypt data made by `encrypt`, with the init vector it starts with'''
+        _cipher = AES.new(self.key, AES.MODE_CFB, enc[:AES.block_size])
         return _cipher.decrypt(enc[AES.block_size:])
 
     def save_data(self, data, filename):
@@ -42,6 +47,19 @@ class AESCipher(object):
             data_enc = encrypted_file.read()
         return self.decrypt(data_enc)
 
+    def encrypt_stream(self, file_in, file_out, chunk_size=1 << 16, iv=None):
+        '''Encrypt binary stream `file_in` into `file_out` chunk by chunk,
+        with init vector `iv` instead of the cipher's own if given.
+        The output layout is the same as `encrypt` produces.'''
+        iv = self.iv if iv is None else iv
+        _cipher = AES.new(self.key, AES.MODE_CFB, iv)
+        file_out.write(iv)
+        nbytes = 0
+        for chunk in iter(lambda: file_in.read(chunk_size), b''):
+            file_out.write(_cipher.encrypt(chunk))
+            nbytes += len(chunk)
+        return nbytes
+
 if __name__ == '__main__':
     key = b'Sixteen byte key'
     iv = Random.new().read(AES.block_size)
@@ -0,0 +1,288 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Indexed archive of recorded voice samples.
+
+An SQLite database next to the recordings keeps, for every WAV file, its
+content hash, sample rate, duration, time of recording and the last
+score it got. Identical captures are stored once. Preprocessed envelopes
+are cached in the same database per envelope engine and pipeline version,
+so re-scoring the archive does no DSP. Retention limits prune the oldest
+recordings together with their files.
+
+Usage: python -m voice_lock.archive [--dir DIR] index | list | rescore
+                                    | prune [--keep N] [--max-age-days D]
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import os.path as osp
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+import scipy.io.wavfile as siw
+
+from .pipeline import default_pipeline, get_envelope_engine
+from .recordings import RECORDING_PATTERN
+from .wave_proc import PIPELINE, _atomic_write, make_waves, read_wav
+
+DB_NAME = 'archive.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS recordings (
+    id INTEGER PRIMARY KEY,
+    sha256 TEXT NOT NULL UNIQUE,
+    path TEXT NOT NULL,
+    sample_rate INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    created REAL NOT NULL,
+    score REAL,
+    metric TEXT,
+    scored REAL
+);
+CREATE INDEX IF NOT EXISTS recordings_created ON recordings (created);
+CREATE TABLE IF NOT EXISTS envelopes (
+    recording_id INTEGER NOT NULL REFERENCES recordings (id) ON DELETE CASCADE,
+    engine TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (recording_id, engine, version)
+);
+'''
+
+Recording = namedtuple('Recording', ['id', 'sha256', 'path', 'sample_rate', 'duration', 'created',
+                                     'score', 'metric', 'scored'])
+
+def samples_digest(data, sample_rate):
+    '''SHA-256 of decoded samples and their rate, independent of WAV headers'''
+    data = np.ascontiguousarray(data)
+    sha = hashlib.sha256()
+    sha.update(f'{sample_rate}:{data.dtype.str}:{data.shape}'.encode())
+    sha.update(data.tobytes())
+    return sha.hexdigest()
+
+def _pack(template):
+    buf = io.BytesIO()
+    np.savez(buf, *[np.asarray(channel, dtype=np.float64) for channel in template])
+    return buf.getvalue()
+
+def _unpack(blob):
+    with np.load(io.BytesIO(blob), allow_pickle=False) as data:
+        return tuple(data[f'arr_{k}'] for k in range(len(data.files)))
+
+class RecordingArchive(object):
+    '''SQLite index of the recordings in `rec_dir`. Safe to share between
+    threads. The database is opened, and created if needed, on first use'''
+
+    def __init__(self, rec_dir, db_path=None):
+        self.rec_dir = rec_dir
+        self.db_path = db_path or osp.join(rec_dir, DB_NAME)
+        self._lock = threading.RLock()
+        self._connection = None
+
+    @property
+    def _db(self):
+        with self._lock:
+            if self._connection is None:
+                os.makedirs(osp.dirname(self.db_path) or '.', exist_ok=True)
+                self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+                self._connection.execute('PRAGMA foreign_keys = ON')
+                self._connection.executescript(SCHEMA)
+            return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    # === Recordings ===
+
+    def add(self, data, sample_rate, path, template=None, created=None):
+        '''Archive recording `data` as WAV file `path`, unless the same
+        samples are archived already. `template` is its envelope, if it was
+        computed. Returns (recording, whether it was new)'''
+        digest = samples_digest(data, sample_rate)
+        existing = self.get(sha256=digest)
+        if existing is not None:
+            return existing, False
+
+        # Write without the lock, so lookups never wait for the disk. If the
+        # same samples were archived meanwhile, the unique hash rejects these
+        _atomic_write(path, lambda f: siw.write(f, sample_rate, data))
+        try:
+            return self._insert(digest, path, sample_rate, len(data) / sample_rate,
+                                created or time.time(), template), True
+        except sqlite3.IntegrityError:
+            os.remove(path)
+            return self.get(sha256=digest), False
+
+    def index(self):
+        '''Index `recording_N.wav` files of the archive directory that are
+        not in the database yet. Returns the number of files added'''
+        with self._lock:
+            known = {row[0] for row in self._db.execute('SELECT path FROM recordings')}
+        added = 0
+        names = os.listdir(self.rec_dir) if osp.isdir(self.rec_dir) else []
+        for name in sorted(names):
+            path = osp.join(self.rec_dir, name)
+            if not RECORDING_PATTERN.match(name) or path in known:
+                continue
+            sample_rate, data = siw.read(path)
+            digest = samples_digest(data, sample_rate)
+            # A writer thread may archive the same samples meanwhile
+            with self._lock:
+                if self.get(sha256=digest) is None:
+                    self._insert(digest, path, sample_rate, len(data) / sample_rate,
+                                 osp.getmtime(path))
+                    added += 1
+        return added
+
+    def _insert(self, digest, path, sample_rate, duration, created, template=None):
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                'INSERT INTO recordings (sha256, path, sample_rate, duration, created) '
+                'VALUES (?, ?, ?, ?, ?)', (digest, path, sample_rate, duration, created))
+            if template is not None:
+                self._store_envelope(cursor.lastrowid, template)
+        return self.get(cursor.lastrowid)
+
+    def get(self, recording_id=None, sha256=None):
+        '''Recording by id or content hash, None if there is none'''
+        column, value = ('id', recording_id) if sha256 is None else ('sha256', sha256)
+        with self._lock:
+            row = self._db.execute(f'SELECT * FROM recordings WHERE {column} = ?',
+                                   (value,)).fetchone()
+        return Recording(*row) if row else None
+
+    def lookup(self, data, sample_rate):
+        '''Archived recording with samples `data`, None if there is none'''
+        return self.get(sha256=samples_digest(data, sample_rate))
+
+    def find(self, since=None, until=None, min_duration=0.0):
+        '''Recordings made between `since` and `until`, oldest first'''
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT * FROM recordings WHERE created >= ? AND created <= ? AND duration >= ? '
+                'ORDER BY created', (since or 0.0, until or float('inf'), min_duration)).fetchall()
+        return [Recording(*row) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM recordings').fetchone()[0]
+
+    def record_score(self, recording_id, score, metric):
+        with self._lock, self._db:
+            self._db.execute('UPDATE recordings SET score = ?, metric = ?, scored = ? WHERE id = ?',
+                             (float(score), metric, time.time(), recording_id))
+
+    def prune(self, keep=None, max_age=None, now=None):
+        '''Delete recordings beyond the newest `keep` ones or older than
+        `max_age` seconds, with their files. Returns the deleted recordings'''
+        now = now or time.time()
+        with self._lock:
+            rows = self._db.execute('SELECT * FROM recordings ORDER BY created DESC').fetchall()
+        doomed = [Recording(*row) for k, row in enumerate(rows)
+                  if (keep is not None and k >= keep) or
+                     (max_age is not None and now - row[5] > max_age)]
+
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM recordings WHERE id = ?',
+                                 [(recording.id,) for recording in doomed])
+        for recording in doomed:
+            if osp.exists(recording.path):
+                os.remove(recording.path)
+        return doomed
+
+    # === Envelopes ===
+
+    def envelope(self, recording, pipeline=None):
+        '''Template of `recording`, taken from the cache or computed from
+        its file and cached'''
+        pipeline = pipeline or default_pipeline()
+        engine = pipeline.engine or get_envelope_engine()
+        template = self._cached(recording, engine)
+        if template is None:
+            template = pipeline(read_wav(recording.path))
+            with self._lock, self._db:
+                self._store_envelope(recording.id, template, engine)
+        return template
+
+    def envelopes(self, recordings):
+        '''Templates of `recordings` for the current envelope engine. Those
+        not cached yet are preprocessed together in batches and cached'''
+        engine = get_envelope_engine()
+        templates = [self._cached(recording, engine) for recording in recordings]
+        missing = [k for k, template in enumerate(templates) if template is None]
+        computed = make_waves([recordings[k].path for k in missing])
+        with self._lock, self._db:
+            for k, template in zip(missing, computed):
+                templates[k] = template
+                self._store_envelope(recordings[k].id, template, engine)
+        return templates
+
+    def _cached(self, recording, engine):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data FROM envelopes WHERE recording_id = ? AND engine = ? AND version = ?',
+                (recording.id, engine, PIPELINE['version'])).fetchone()
+        return _unpack(row[0]) if row is not None else None
+
+    def _store_envelope(self, recording_id, template, engine=None):
+        self._db.execute('INSERT OR REPLACE INTO envelopes VALUES (?, ?, ?, ?)',
+                         (recording_id, engine or get_envelope_engine(), PIPELINE['version'],
+                          _pack(template)))
+
+    def rescore(self, score, metric, recordings=None):
+        '''Score every recording (or the given ones) with `score(template)`
+        and store the results. Returns list of (recording, score)'''
+        recordings = list(recordings) if recordings is not None else self.find()
+        results = []
+        for recording, template in zip(recordings, self.envelopes(recordings)):
+            conf = score(template)
+            self.record_score(recording.id, conf, metric)
+            results.append((recording, conf))
+        return results
+
+def main(argv=None):
+    from .verify import DATA_DIR, REFS_PATH, load_ref_samples, make_cipher, score
+
+    parser = argparse.ArgumentParser(prog='voice_lock.archive', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=osp.join(DATA_DIR, 'rec_samples'),
+                        help='recordings directory')
+    parser.add_argument('--metric', default='ncc', help='similarity metric for rescore')
+    parser.add_argument('--keep', type=int, default=None, help='prune: recordings to keep')
+    parser.add_argument('--max-age-days', type=float, default=None,
+                        help='prune: delete recordings older than this')
+    parser.add_argument('command', choices=('index', 'list', 'rescore', 'prune'))
+    args = parser.parse_args(argv)
+
+    archive = RecordingArchive(args.dir)
+    if args.command == 'index':
+        print(f'{archive.index()} recordings indexed, {len(archive)} in archive')
+    elif args.command == 'list':
+        for r in archive.find():
+            scored = '' if r.score is None else f'  {r.metric} {r.score:.3f}'
+            print(f'{r.id:4d}  {time.strftime("%Y-%m-%d %H:%M", time.localtime(r.created))}  '
+                  f'{r.duration:5.2f} s  {osp.basename(r.path)}{scored}')
+    elif args.command == 'rescore':
+        refs = load_ref_samples(REFS_PATH, make_cipher())
+        start = time.perf_counter()
+        results = archive.rescore(lambda template: score(template, refs, metric=args.metric),
+                                  args.metric)
+        print(f'{len(results)} recordings rescored in {time.perf_counter() - start:.2f} s')
+    else:
+        max_age = None if args.max_age_days is None else args.max_age_days * 86400
+        print(f'{len(archive.prune(keep=args.keep, max_age=max_age))} recordings pruned')
+    archive.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Interchangeable implementations of the `corr` min-sum kernel.
+
+A backend is a function `rows(wave, wave2, start, stop)` returning
+`cor[start:stop]`, where `cor[i]` is the sum of `min(wave2[j], wave[i + j])`
+over `j`. `corr` calls it in chunks of rows, so cancellation checks keep
+working with every backend.
+
+    python  the original element-by-element loops, kept as the reference
+    numpy   vectorized over sliding windows, the default
+    numba   compiled loops, available when numba is installed
+
+The backend is picked by `select_backend`, else by the VOICE_LOCK_BACKEND
+environment variable. 'auto', the default, times the available backends
+on a synthetic pair once and uses the fastest one. The python reference
+is left out of that race. It is only used when chosen explicitly, or to
+check that the other backends agree with it.
+"""
+
+import functools
+import importlib
+import os
+import threading
+import time
+
+import numpy as np
+
+ENV_VAR = 'VOICE_LOCK_BACKEND'
+
+### ~~~ Kernels ~~~ ###
+
+def rows_python(wave, wave2, start, stop):
+    cor = np.zeros(stop - start)
+    for i in range(start, stop):
+        for j in range(len(wave2)):
+            cor[i - start] += min(wave2[j], wave[i + j])
+    return cor
+
+def rows_numpy(wave, wave2, start, stop):
+    windows = np.lib.stride_tricks.sliding_window_view(wave, len(wave2))[start:stop]
+    return np.minimum(windows, wave2).sum(1)
+
+def build_numba():
+    '''Compile the loop kernel with numba'''
+    import numba
+
+    @numba.njit(cache=True, nogil=True)
+    def rows_numba(wave, wave2, start, stop):
+        cor = np.zeros(stop - start)
+        for i in range(start, stop):
+            acc = 0.0
+            for j in range(len(wave2)):
+                a = wave2[j]
+                b = wave[i + j]
+                acc += a if a < b else b
+            cor[i - start] = acc
+        return cor
+
+    return rows_numba
+
+### ~~~ Registry ~~~ ###
+
+# Backend name -> (factory returning the kernel, whether it can be built)
+_factories = {}
+_kernels = {}
+_selected = None
+_fastest = None
+_lock = threading.Lock()
+
+# Backends 'auto' never picks, so they are not timed on first use either
+NOT_AUTO = {'python'}
+
+def register_backend(name, factory, available=lambda: True):
+    '''Register kernel built by `factory()` on first use. `available()`
+    tells whether it can be built on this host'''
+    with _lock:
+        _factories[name] = (factory, available)
+        _kernels.pop(name, None)
+
+@functools.lru_cache(maxsize=None)
+def importable(module):
+    '''Whether `module` imports, not just whether it is installed. numba
+    fails to import next to a NumPy version it does not support'''
+    try:
+        importlib.import_module(module)
+    except Exception:
+        return False
+    return True
+
+register_backend('python', lambda: rows_python)
+register_backend('numpy', lambda: rows_numpy)
+register_backend('numba', build_numba, available=lambda: importable('numba'))
+
+def available_backends():
+    '''Names of the backends that can be used on this host'''
+    return [name for name, (_, available) in _factories.items() if available()]
+
+def select_backend(name):
+    '''Use backend `name` ('auto' or None for the fastest) from now on'''
+    global _selected
+    if name not in (None, 'auto'):
+        _load(name)
+    _selected = name
+
+def get_backend(name=None):
+    '''Kernel of backend `name`, or of the selected one if None'''
+    name = name or _selected or os.environ.get(ENV_VAR) or 'auto'
+    if name == 'auto':
+        name = fastest_backend()
+    return _load(name)
+
+def _load(name):
+    with _lock:
+        if name not in _kernels:
+            if name not in _factories:
+                raise ValueError(f'Unknown backend {name!r}, expected one of {sorted(_factories)}')
+            factory, available = _factories[name]
+            if not available():
+                raise ValueError(f'Backend {name!r} is not available on this host')
+            _kernels[name] = factory()
+        return _kernels[name]
+
+def benchmark(names=None, size=200, repeat=3, seed=0):
+    '''Best time in seconds of one `corr`-sized run of each backend on a
+    random pair of `size` values. Kernels are warmed up first, so one-off
+    compilation is not counted'''
+    rng = np.random.default_rng(seed)
+    wave = np.zeros(3 * size)
+    wave[size:2 * size] = rng.random(size)
+    wave2 = rng.random(size)
+    rows = 2 * size + 1
+
+    times = {}
+    for name in names or available_backends():
+        kernel = _load(name)
+        kernel(wave, wave2, 0, 1)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            kernel(wave, wave2, 0, rows)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times[name] = best
+    return times
+
+def fastest_backend():
+    '''Name of the fastest available backend outside `NOT_AUTO`,
+    benchmarked once. Backends failing to build or run are left out'''
+    global _fastest
+    if _fastest is None:
+        times = {}
+        for name in available_backends():
+            if name in NOT_AUTO:
+                continue
+            try:
+                times.update(benchmark([name]))
+            except Exception:
+                continue
+        _fastest = min(times, key=times.get)
+    return _fastest
@@ -0,0 +1,348 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Benchmarks and accuracy reports on the bundled samples.
+
+Usage: python -m voice_lock.bench <report>
+"""
+
+import argparse
+import glob
+import itertools
+import os
+import os.path as osp
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from .verify import DATA_DIR, REFS_PATH, find_ref_samples, make_cipher
+from .backends import available_backends, benchmark, fastest_backend
+from .consolidate import consolidate, score_consolidated
+from .loader import load_bank
+from .pipeline import ENVELOPES, make_pipeline, process_batch
+from .template_cache import template_nbytes
+from .wave_proc import (METRICS, THRESHOLDS, corr, corr_pruned, corr_pyramid, corr_tuple,
+                        make_enc_wave, make_pyramid, make_wave, make_waves, minsum_max, quantize,
+                        read_wav)
+
+TEST_PATH = osp.join(DATA_DIR, 'test_samples')
+
+### ~~~ Bundled data ~~~ ###
+
+def load_bundled(pipeline=None):
+    '''Load templates of the bundled samples.
+    Returns (refs, genuine, impostor) lists of templates: the Master's
+    references, the Master's test clips (`master_*.wav`) and the other
+    test clips, which are treated as impostors'''
+    cipher = make_cipher()
+    refs = [make_enc_wave(path, cipher, pipeline) for path in find_ref_samples(REFS_PATH)]
+
+    genuine, impostor = [], []
+    for path in sorted(glob.glob(osp.join(TEST_PATH, '*.wav'))):
+        group = genuine if osp.basename(path).startswith('master') else impostor
+        group.append(make_wave(path, pipeline))
+
+    return refs, genuine, impostor
+
+def trial_pairs(refs, genuine, impostor):
+    '''Genuine and impostor (template, template) trial pairs: every pair of
+    references plus every test clip against every reference'''
+    genuine_pairs = list(itertools.combinations(refs, 2))
+    genuine_pairs += list(itertools.product(genuine, refs))
+    impostor_pairs = list(itertools.product(impostor, refs))
+    return genuine_pairs, impostor_pairs
+
+def eer(genuine_scores, impostor_scores):
+    '''Equal error rate of accepting `score > threshold`.
+    Returns (eer, threshold) at the point where FAR and FRR are closest'''
+    genuine_scores = np.asarray(genuine_scores)
+    impostor_scores = np.asarray(impostor_scores)
+
+    best = None
+    for threshold in np.unique(np.concatenate([genuine_scores, impostor_scores])):
+        frr = np.mean(genuine_scores <= threshold)
+        far = np.mean(impostor_scores > threshold)
+        if best is None or abs(far - frr) < best[0]:
+            best = (abs(far - frr), (far + frr) / 2, threshold)
+    return best[1], best[2]
+
+def timed_scores(score, pairs):
+    '''Apply `score` to each pair. Returns (scores, mean seconds per pair)'''
+    start = time.perf_counter()
+    scores = [score(t1, t2) for t1, t2 in pairs]
+    return scores, (time.perf_counter() - start) / len(pairs)
+
+### ~~~ Reports ~~~ ###
+
+def report_metrics():
+    '''Speed and EER of every similarity metric'''
+    genuine_pairs, impostor_pairs = trial_pairs(*load_bundled())
+    print(f'{len(genuine_pairs)} genuine and {len(impostor_pairs)} impostor trials')
+    print(f'{"metric":>8} {"ms/pair":>10} {"EER":>6} {"threshold":>10}')
+
+    for metric in METRICS:
+        score = lambda t1, t2: corr_tuple(t1, t2, metric=metric)
+        genuine_scores, seconds = timed_scores(score, genuine_pairs)
+        impostor_scores, _ = timed_scores(score, impostor_pairs)
+        rate, threshold = eer(genuine_scores, impostor_scores)
+        print(f'{metric:>8} {seconds * 1e3:>10.2f} {rate:>6.1%} {threshold:>10.4f}')
+
+def report_pyramid():
+    '''Agreement and work of coarse-to-fine search against exhaustive `corr`'''
+    refs, genuine, impostor = load_bundled()
+    genuine_pairs, impostor_pairs = trial_pairs(refs, genuine, impostor)
+    channels = [(np.asarray(w1, dtype=np.float64), np.asarray(w2, dtype=np.float64))
+                for t1, t2 in genuine_pairs + impostor_pairs for w1, w2 in zip(t1, t2)]
+    pyramids = [make_pyramid(pair) for pair in channels]
+
+    exhaustive, exhaustive_time = timed_scores(corr, channels)
+    stats = {}
+    coarse_to_fine, pyramid_time = timed_scores(
+        lambda p1, p2: corr_pyramid(p1, p2, stats=stats), pyramids)
+
+    diff = np.abs(np.asarray(exhaustive) - np.asarray(coarse_to_fine))
+    print(f'{len(channels)} channel comparisons')
+    print(f'exhaustive:     {exhaustive_time * 1e3:8.2f} ms/channel')
+    print(f'coarse-to-fine: {pyramid_time * 1e3:8.2f} ms/channel')
+    print(f'agreeing scores: {np.mean(diff < 1e-9):.1%}, max difference {diff.max():.2e}')
+    print(f'element comparisons: {stats["comparisons"] / stats["exhaustive"]:.1%} of exhaustive')
+
+def report_pruning(blocks=(16, 64, 256)):
+    '''Work and speed of the pruned shift search against exhaustive `corr`
+    for both seeds and several block sizes'''
+    genuine_pairs, impostor_pairs = trial_pairs(*load_bundled())
+    channels = [(np.asarray(w1, dtype=np.float64), np.asarray(w2, dtype=np.float64))
+                for t1, t2 in genuine_pairs + impostor_pairs for w1, w2 in zip(t1, t2)]
+    exhaustive, exhaustive_time = timed_scores(corr, channels)
+    print(f'{len(channels)} channel comparisons, exhaustive {exhaustive_time * 1e3:.2f} ms/channel')
+
+    print(f'{"seed":>8} {"block":>5} {"ms/channel":>10} {"pruned":>7} {"max diff":>9}')
+    for seed, block in itertools.product(('zero', 'centroid'), blocks):
+        stats = {}
+        scores, seconds = timed_scores(
+            lambda w1, w2: corr_pruned(w1, w2, seed=seed, block=block, stats=stats), channels)
+        diff = np.abs(np.asarray(scores) - np.asarray(exhaustive)).max()
+        print(f'{seed:>8} {block:>5} {seconds * 1e3:>10.2f} '
+              f'{stats["pruned"] / stats["shifts"]:>7.1%} {diff:>9.2e}')
+
+def report_backends(pairs=3):
+    '''Agreement and speed of the `corr` backends on the bundled samples.
+    The first `pairs` genuine and impostor trials are scored by every
+    backend and compared with the reference Python loops'''
+    genuine_pairs, impostor_pairs = trial_pairs(*load_bundled())
+    trials = genuine_pairs[:pairs] + impostor_pairs[:pairs]
+    names = available_backends()
+    print(f'available backends: {", ".join(names)}')
+
+    base = None
+    print(f'{"backend":>8} {"ms/pair":>10} {"max diff":>9}')
+    for name in ['python'] + [name for name in names if name != 'python']:
+        score = lambda t1, t2: corr_tuple(t1, t2, metric='minsum', backend=name)
+        score(*trials[0])  # warm up, numba compiles on first call
+        scores, seconds = timed_scores(score, trials)
+        if base is None:
+            base = np.asarray(scores)
+        print(f'{name:>8} {seconds * 1e3:>10.2f} {np.abs(np.asarray(scores) - base).max():>9.2e}')
+
+    times = benchmark()
+    print('self-benchmark: ' + ', '.join(f'{name} {t * 1e3:.2f} ms' for name, t in times.items()))
+    print(f'auto selects {fastest_backend()}')
+
+def report_envelopes(metrics=('minsum', 'ncc')):
+    '''Size, speed and EER of templates made by each envelope engine'''
+    print(f'{"engine":>8} {"channels":>8} {"values":>7} {"prep ms":>8} {"metric":>7} '
+          f'{"ms/pair":>8} {"EER":>6} {"threshold":>10}')
+    for engine in ENVELOPES:
+        pipeline = make_pipeline(engine)
+        load_bundled(pipeline)  # warm up
+        pipeline.reset_timings()
+        refs, genuine, impostor = load_bundled(pipeline)
+        prep = sum(pipeline.timings.values()) / pipeline.calls
+        genuine_pairs, impostor_pairs = trial_pairs(refs, genuine, impostor)
+        values = np.mean([sum(len(channel) for channel in template) for template in refs])
+
+        for metric in metrics:
+            score = lambda t1, t2: corr_tuple(t1, t2, metric=metric)
+            score(*genuine_pairs[0])  # warm up lazy imports and backend
+            genuine_scores, seconds = timed_scores(score, genuine_pairs)
+            impostor_scores, _ = timed_scores(score, impostor_pairs)
+            rate, threshold = eer(genuine_scores, impostor_scores)
+            print(f'{engine:>8} {len(refs[0]):>8} {values:>7.0f} {prep * 1e3:>8.2f} {metric:>7} '
+                  f'{seconds * 1e3:>8.2f} {rate:>6.1%} {threshold:>10.4f}')
+
+def report_loader(runs=5):
+    '''Cold load time of the reference bank, one file after another and
+    with the concurrent loader'''
+    cipher = make_cipher()
+    paths = find_ref_samples(REFS_PATH)
+
+    def sequential():
+        return [make_pyramid(make_enc_wave(path, cipher)) for path in paths]
+
+    load_bank(paths, cipher)  # warm up imports and the page cache
+    seq_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        sequential()
+        seq_times.append(time.perf_counter() - start)
+    banks = [load_bank(paths, cipher) for _ in range(runs)]
+    bank = min(banks, key=lambda bank: bank.timings['wall'])
+
+    same = all(np.array_equal(np.asarray(c1), np.asarray(c2))
+               for t1, t2 in zip(sequential(), bank) for c1, c2 in zip(t1, t2))
+    print(f'{len(paths)} references, best of {runs} runs, identical templates: {same}')
+    print(f'sequential: {min(seq_times) * 1e3:8.1f} ms')
+    print(f'concurrent: {bank.timings["wall"] * 1e3:8.1f} ms')
+    print('stage totals: ' + ', '.join(f'{stage} {bank.timings[stage] * 1e3:.1f} ms'
+                                       for stage in ('read', 'decrypt', 'decode', 'process')))
+
+def report_batch(batch_sizes=(8, 32, 128), clip_seconds=0.25, runs=5):
+    '''Throughput of batched preprocessing against one clip at a time, on
+    the directories of bundled WAV files and on short clips cut from them'''
+    best = lambda func: min(timed_scores(lambda _, __: func(), [(None, None)])[1]
+                            for _ in range(runs))
+    paths = sorted(glob.glob(osp.join(DATA_DIR, '*', '*.wav')))
+    make_waves(paths)  # warm up the page cache and buffers
+    print(f'{len(paths)} bundled files read and preprocessed, best of {runs} runs')
+    print(f'one at a time: {len(paths) / best(lambda: [make_wave(path) for path in paths]):6.0f} clips/s')
+    print(f'make_waves:    {len(paths) / best(lambda: make_waves(paths)):6.0f} clips/s')
+
+    files = [read_wav(path) for path in paths]
+    size = int(clip_seconds * 44100)
+    short = [data[start:start + size] for data in files
+             for start in range(0, len(data) - size, size)]
+    print(f'\n{"clips":>12} {"engine":>8} {"batch":>5} {"clips/s":>9} {"speedup":>7} {"max diff":>9}')
+    for name, clips in (('files', files), (f'{clip_seconds:g} s cuts', short)):
+        for engine in ENVELOPES:
+            pipeline = make_pipeline(engine)
+            single = [pipeline(data) for data in clips]  # warm up buffers
+            single_time = best(lambda: [pipeline(data) for data in clips])
+            print(f'{name:>12} {engine:>8} {1:>5} {len(clips) / single_time:>9.0f} {1:>7.1f}')
+            for batch_size in batch_sizes:
+                run = lambda: [template for k in range(0, len(clips), batch_size)
+                               for template in process_batch(clips[k:k + batch_size], pipeline)]
+                batch_time = best(run)
+                diff = max(np.abs(np.asarray(c1) - c2).max(initial=0)
+                           for t1, t2 in zip(single, run()) for c1, c2 in zip(t1, t2))
+                print(f'{name:>12} {engine:>8} {batch_size:>5} {len(clips) / batch_time:>9.0f} '
+                      f'{single_time / batch_time:>7.1f} {diff:>9.2e}')
+
+def report_quantized():
+    '''Template size and accuracy of quantized templates against float ones'''
+    refs, genuine, impostor = load_bundled()
+    templates = refs + genuine + impostor
+    values = sum(len(channel) for template in templates for channel in template)
+
+    # Float scores by the same all-shifts search, which equals `corr`
+    def float_score(t1, t2):
+        return np.mean([minsum_max(np.asarray(w1, dtype=np.float64), np.asarray(w2, dtype=np.float64)) /
+                        max(np.sum(w1), np.sum(w2)) for w1, w2 in zip(t1, t2)])
+
+    variants = [('float64', None), ('uint16', 16), ('uint8', 8)]
+    lists = sum(template_nbytes(tuple(list(channel) for channel in t)) for t in templates)
+    print(f'{len(templates)} templates, {values} values, as Python lists {lists / values:.1f} B/value')
+    print(f'{"format":>8} {"B/value":>8} {"vs lists":>8} {"ms/pair":>8} {"max diff":>9} '
+          f'{"EER":>6} {"flips":>6}')
+
+    pairs = trial_pairs(refs, genuine, impostor)
+    base = None
+    for name, bits in variants:
+        if bits is None:
+            nbytes = sum(template_nbytes(t) for t in templates)
+            score = float_score
+            data = pairs
+        else:
+            quantized = {id(t): quantize(t, bits) for t in templates}
+            nbytes = sum(template_nbytes(q) for q in quantized.values())
+            score = lambda t1, t2: corr_tuple(t1, t2, metric='minsum-int')
+            data = [[(quantized[id(t1)], quantized[id(t2)]) for t1, t2 in group] for group in pairs]
+
+        genuine_scores, seconds = timed_scores(score, data[0])
+        impostor_scores, _ = timed_scores(score, data[1])
+        scores = np.asarray(genuine_scores + impostor_scores)
+        if base is None:
+            base = scores
+        flips = np.sum((scores > THRESHOLDS['minsum']) != (base > THRESHOLDS['minsum']))
+        rate, _ = eer(genuine_scores, impostor_scores)
+        print(f'{name:>8} {nbytes / values:>8.2f} {lists / nbytes:>7.1f}x {seconds * 1e3:>8.2f} '
+              f'{np.abs(scores - base).max():>9.2e} {rate:>6.1%} {flips:>6}')
+
+def report_consolidate(metric='minsum-int'):
+    '''Comparisons and decisions of medoid-first scoring against the full
+    bank. Test clips are scored against all references, and every
+    reference against the other ones'''
+    refs, genuine, impostor = load_bundled()
+    threshold = THRESHOLDS[metric]
+    trials = [(test, refs, 'test') for test in genuine + impostor]
+    trials += [(ref, refs[:k] + refs[k + 1:], 'held-out') for k, ref in enumerate(refs)]
+
+    print(f'{"trial":>8} {"medoids":>7} {"full":>7} {"medoid":>7} {"compared":>8} {"agree":>5}')
+    comparisons = total = agree = 0
+    for test, bank, name in trials:
+        consolidation = consolidate(bank, metric)
+        full = np.mean([corr_tuple(test, ref, metric) for ref in bank])
+        conf, compared, _ = score_consolidated(test, bank, consolidation, threshold, metric)
+        same = (conf > threshold) == (full > threshold)
+        comparisons += compared
+        total += len(bank)
+        agree += same
+        print(f'{name:>8} {len(consolidation):>7} {full:>7.3f} {conf:>7.3f} '
+              f'{compared:>4}/{len(bank):<3} {"yes" if same else "NO":>5}')
+    print(f'{comparisons / total:.0%} of comparisons, {agree}/{len(trials)} decisions agree')
+
+STARTUP_SCRIPT = '''
+import time
+start = time.perf_counter()
+from PyQt5 import QtWidgets
+app = QtWidgets.QApplication([])
+from voice_lock.main_window import MainWindow
+imported = time.perf_counter()
+window = MainWindow()
+print(imported - start, time.perf_counter() - imported)
+'''
+
+def report_startup(runs=5):
+    '''Import and window construction time of the GUI, each in a fresh
+    interpreter'''
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [osp.dirname(osp.dirname(osp.abspath(__file__))),
+                                                      env.get('PYTHONPATH')]))
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=env, check=True,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        times.append([float(t) for t in out.split()[-2:]])
+
+    imported, constructed = np.median(times, axis=0)
+    print(f'median of {runs} runs')
+    print(f'import:    {imported * 1e3:8.1f} ms')
+    print(f'window:    {constructed * 1e3:8.1f} ms')
+    print(f'total:     {(imported + constructed) * 1e3:8.1f} ms')
+
+REPORTS = {
+    'backends': report_backends,
+    'batch': report_batch,
+    'consolidate': report_consolidate,
+    'envelopes': report_envelopes,
+    'loader': report_loader,
+    'metrics': report_metrics,
+    'pruning': report_pruning,
+    'pyramid': report_pyramid,
+    'quantized': report_quantized,
+    'startup': report_startup,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='voice_lock.bench', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('report', choices=sorted(REPORTS))
+    args = parser.parse_args(argv)
+    REPORTS[args.report]()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Verification within a latency budget.
+
+The test sample is scored at increasing fidelity: coarse envelopes against
+a few references, coarse envelopes against all of them, coarse-to-fine
+alignment and finally the exact metric. Each level gives a complete
+confidence estimate. When the deadline passes, the running level is
+abandoned and the decision of the last completed one is returned.
+
+Coarse envelopes are smoother, so their min-sum scores come out higher.
+Their estimates are corrected by the mean bias measured between pairs of
+the bundled references, separately for each envelope engine.
+"""
+
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from .pipeline import get_envelope_engine
+from .wave_proc import (Cancelled, Pyramid, corr_pyramid, corr_tuple, default_threshold,
+                        make_pyramid, minsum_at)
+
+# Min-sum family metrics, which the coarse levels approximate
+MINSUM_METRICS = ('minsum', 'pyramid', 'minsum-int', 'minsum-pruned')
+
+# Mean excess of min-sum at pyramid depth 1 (block 300) and 2 (block 1200)
+# over the exact score, across pairs of the bundled references, by envelope
+# engine. Engines without an entry skip the coarse levels
+COARSE_BIAS = {
+    'block': {1: 0.068, 2: 0.092},
+    'hilbert': {1: 0.048, 2: 0.064},
+}
+
+SUBSET_SIZE = 2  # references scored at the cheapest level without medoids
+
+class Deadline(Cancelled):
+    '''Raised inside a comparison when the time budget is spent'''
+
+DeadlineResult = namedtuple('DeadlineResult', ['confidence', 'accepted', 'level', 'levels',
+                                               'cut_short', 'seconds'])
+
+def coarse_corr(wave1, wave2, depth, check=None, engine=None):
+    '''Min-sum score over all shifts at pyramid level `depth` of envelopes
+    made by `engine`, the current one by default'''
+    bias = COARSE_BIAS[engine or get_envelope_engine()][depth]
+    level1, level2 = wave1.levels[depth], wave2.levels[depth]
+    if check is not None:
+        check(0)
+    if not len(level1) or not len(level2):
+        return 0.0
+    cor = minsum_at(level1, level2, np.arange(-len(level2) + 1, len(level1)))
+    return cor.max() / max(level1.sum(), level2.sum()) - bias
+
+def warm_up(metric):
+    '''Run `metric` once on a tiny pair, so lazy imports and the backend
+    self-benchmark do not count against a deadline'''
+    tiny = ([1.0, 0.5], [0.5, 1.0])
+    corr_tuple(tiny, tiny, metric)
+
+def fidelity_levels(metric, ref_count, subset=None, engine=None):
+    '''(name, reference indices, similarity) of each level, cheapest first,
+    for templates made by envelope `engine`'''
+    engine = engine or get_envelope_engine()
+    everyone = list(range(ref_count))
+    subset = list(subset) if subset is not None else everyone[:SUBSET_SIZE]
+    levels = []
+    if metric in MINSUM_METRICS:
+        if engine in COARSE_BIAS:
+            coarse = lambda depth: (lambda w1, w2, check=None:
+                                    coarse_corr(w1, w2, depth, check, engine))
+            levels += [('coarse-subset', subset, coarse(2)),
+                       ('coarse', everyone, coarse(2)),
+                       ('medium', everyone, coarse(1))]
+        levels.append(('pyramid', everyone, corr_pyramid))
+    else:
+        levels.append(('subset', subset, None))
+    levels.append(('exact', everyone, None))
+    return levels
+
+def verify_with_deadline(test_sample, ref_samples, budget, metric='minsum', threshold=None,
+                         subset=None, check=None, start=None):
+    '''Verify `test_sample` against `ref_samples` within `budget` seconds.
+    `subset` lists the references scored at the cheapest level, e.g. the
+    medoids of a consolidation. Fails closed if no level completes.
+    `check(done)` gets the fraction of levels done and may raise `Cancelled`
+    to abort the whole call. `start` is the `time.monotonic()` the budget
+    counts from, if the caller started the clock before getting here.
+    Returns `DeadlineResult` naming the last completed fidelity level'''
+    warm_up(metric)
+    start = time.monotonic() if start is None else start
+    end = start + budget
+    if threshold is None:
+        threshold = default_threshold(metric)
+
+    levels = fidelity_levels(metric, len(ref_samples), subset)
+    position = [0.0]
+
+    def check_deadline(done):
+        if check is not None:
+            check(position[0])
+        if time.monotonic() > end:
+            raise Deadline
+
+    pyramids = {}
+    def pyramid(template):
+        if all(isinstance(channel, Pyramid) for channel in template):
+            return template
+        if id(template) not in pyramids:
+            pyramids[id(template)] = (make_pyramid(template), template)
+        return pyramids[id(template)][0]
+
+    conf = level = None
+    cut_short = False
+    for k, (name, indices, sim) in enumerate(levels):
+        try:
+            scores = []
+            for n, i in enumerate(indices):
+                position[0] = (k + n / len(indices)) / len(levels)
+                check_deadline(0)
+                if sim is None:
+                    scores.append(corr_tuple(test_sample, ref_samples[i], metric,
+                                             check=check_deadline))
+                else:
+                    test, ref = pyramid(test_sample), pyramid(ref_samples[i])
+                    scores.append(np.mean([sim(w1, w2, check=check_deadline)
+                                           for w1, w2 in zip(test, ref)]))
+        except Deadline:
+            cut_short = True
+            break
+        conf, level = float(np.mean(scores)), name
+
+    return DeadlineResult(confidence=conf,
+                          accepted=conf is not None and conf > threshold,
+                          level=level,
+                          levels=[name for name, _, _ in levels],
+                          cut_short=cut_short,
+                          seconds=time.monotonic() - start)
@@ -0,0 +1,88 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Concurrent loading of the reference bank.
+
+Loading a reference takes a file read, AES decryption, WAV decoding and
+preprocessing. Here reads run on an I/O thread pool, and every finished
+read is handed on to a CPU thread pool for the rest. So the stages of
+different files overlap. At most `max_in_flight` files are between
+reading and done, which bounds memory. Templates come back in the order
+of the paths whatever order they finish in.
+"""
+
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import scipy.io.wavfile as siw
+
+from .pipeline import default_pipeline
+from .wave_proc import make_pyramid
+
+class ReferenceBank(object):
+    '''Loaded reference templates with their paths and stage timings'''
+
+    def __init__(self, paths, templates, timings):
+        self.paths = list(paths)
+        self.templates = list(templates)
+        self.timings = timings  # seconds per stage summed over files, and wall time
+
+    def __len__(self):
+        return len(self.templates)
+
+    def __getitem__(self, i):
+        return self.templates[i]
+
+    def __iter__(self):
+        return iter(self.templates)
+
+def load_bank(paths, cipher, io_workers=4, cpu_workers=None, max_in_flight=None,
+              make_template=make_pyramid):
+    '''Load encrypted references in `paths` into a `ReferenceBank`.
+    `make_template` turns a preprocessed waveform tuple into the stored
+    template. CPU workers default to the number of CPUs and
+    `max_in_flight` to twice the CPU workers'''
+    start = time.perf_counter()
+    cpu_workers = cpu_workers or max(1, min(os.cpu_count() or 1, len(paths)))
+    slots = threading.BoundedSemaphore(max_in_flight or 2 * cpu_workers)
+    timings = {'read': 0.0, 'decrypt': 0.0, 'decode': 0.0, 'process': 0.0}
+    lock = threading.Lock()
+
+    def timed(stage, func, *args):
+        stage_start = time.perf_counter()
+        result = func(*args)
+        with lock:
+            timings[stage] += time.perf_counter() - stage_start
+        return result
+
+    def process(data):
+        try:
+            data = timed('decrypt', cipher.decrypt, data)
+            samples = timed('decode', lambda: siw.read(io.BytesIO(data))[1])
+            return timed('process', lambda: make_template(default_pipeline()(samples)))
+        finally:
+            slots.release()
+
+    def read(path):
+        try:
+            with open(path, 'rb') as f:
+                data = timed('read', f.read)
+        except BaseException:
+            slots.release()
+            raise
+        return cpu_pool.submit(process, data)
+
+    with ThreadPoolExecutor(cpu_workers) as cpu_pool, ThreadPoolExecutor(io_workers) as io_pool:
+        reads = []
+        for path in paths:
+            slots.acquire()
+            reads.append(io_pool.submit(read, path))
+        templates = [future.result().result() for future in reads]
+
+    timings['wall'] = time.perf_counter() - start
+    return ReferenceBank(paths, templates, timings)
@@ -0,0 +1,219 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Load generator for the verification pipeline.
+
+Every request preprocesses one decoded clip and scores it against the
+reference bank, as a login does. Requests are issued by `concurrency`
+closed-loop clients, each sending its next request once the previous one
+is answered, and run on a thread or a process pool. The pool sees the
+bank through `SharedBank`, so only the clip travels with a request.
+
+Clips are drawn from the bundled test samples and from synthetic audio
+generated here, mixed by weight. Everything runs offline.
+
+Usage: python -m voice_lock.loadtest [--executor thread,process]
+                                     [--concurrency 1,2,4] [--requests N]
+                                     [--mix bundled=1,synthetic=1]
+                                     [--lengths 1,3] [--metric ncc]
+"""
+
+import argparse
+import glob
+import os
+import os.path as osp
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from . import shared_bank
+from .pipeline import default_pipeline
+from .verify import DATA_DIR, find_ref_samples, make_cipher, score
+from .wave_proc import METRICS, make_enc_wave, read_wav
+
+SAMPLE_RATE = 44100
+EXECUTORS = ('thread', 'process')
+
+### ~~~ Request clips ~~~ ###
+
+def synth_clip(seconds, rng, rate=SAMPLE_RATE):
+    '''Speech-like int16 stereo clip: a few harmonics of a gliding pitch
+    under a syllable-rate envelope, plus background noise'''
+    t = np.arange(int(seconds * rate)) / rate
+    pitch = rng.uniform(90, 220) * (1 + 0.1 * np.sin(2 * np.pi * rng.uniform(0.5, 2) * t))
+    phase = 2 * np.pi * np.cumsum(pitch) / rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+    syllables = np.maximum(np.sin(2 * np.pi * rng.uniform(3, 6) * t + rng.uniform(0, np.pi)), 0)
+    wave = voice * syllables + 0.05 * rng.standard_normal(len(t))
+    wave = 0.5 * wave / np.max(np.abs(wave)) * 32767
+    return np.repeat(wave.astype(np.int16)[:, None], 2, axis=1)
+
+def bundled_clips():
+    '''Decoded samples of the bundled test clips'''
+    return [read_wav(path) for path in sorted(glob.glob(osp.join(DATA_DIR, 'test_samples', '*.wav')))]
+
+def parse_mix(text):
+    '''Parse `source=weight,...` into a dict of normalized weights'''
+    mix = {}
+    for item in text.split(','):
+        source, _, weight = item.partition('=')
+        if source not in ('bundled', 'synthetic'):
+            raise ValueError(f'Unknown clip source {source!r}, expected bundled or synthetic')
+        mix[source] = float(weight or 1)
+    total = sum(mix.values())
+    if total <= 0:
+        raise ValueError('Request mix has no positive weights')
+    return {source: weight / total for source, weight in mix.items()}
+
+def make_requests(count, mix, lengths, seed=0):
+    '''List of `count` decoded clips drawn from `mix`. Synthetic clips take
+    lengths in seconds from `lengths` in turn'''
+    rng = np.random.default_rng(seed)
+    bundled = bundled_clips() if mix.get('bundled') else []
+    sources = rng.choice(list(mix), size=count, p=list(mix.values()))
+
+    clips = []
+    for i, source in enumerate(sources):
+        if source == 'bundled':
+            clips.append(bundled[rng.integers(len(bundled))])
+        else:
+            clips.append(synth_clip(lengths[i % len(lengths)], rng))
+    return clips
+
+### ~~~ Request handlers ~~~ ###
+
+# Thread workers share the bank of the parent process
+_thread_refs = None
+
+# Handlers return (score, CPU seconds spent by the worker process)
+
+def _verify_local(data, metric):
+    return score(default_pipeline()(data), _thread_refs, metric=metric), 0.0
+
+def _verify_shared(data, metric):
+    '''Runs in a pool process attached to the bank by `shared_bank.init_worker`'''
+    start = time.process_time()
+    conf = score(default_pipeline()(data), shared_bank.worker_view().templates(), metric=metric)
+    return conf, time.process_time() - start
+
+### ~~~ Load generation ~~~ ###
+
+def _cpu_seconds():
+    '''CPU time of this process, including its threads'''
+    times = os.times()
+    return times.user + times.system
+
+def run_load(clips, refs, executor='thread', concurrency=1, metric='ncc'):
+    '''Send `clips` as requests from `concurrency` closed-loop clients.
+    Returns a report dict with throughput, latency percentiles and CPU use'''
+    global _thread_refs
+    if executor not in EXECUTORS:
+        raise ValueError(f'Unknown executor {executor!r}, expected one of {EXECUTORS}')
+
+    latencies = []
+    worker_cpu = []
+    queue = iter(range(len(clips)))
+    lock = threading.Lock()
+
+    def client(pool, handler):
+        while True:
+            with lock:
+                i = next(queue, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            _, cpu = pool.submit(handler, clips[i], metric).result()
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                worker_cpu.append(cpu)
+
+    bank = None
+    try:
+        if executor == 'thread':
+            _thread_refs = refs
+            pool = ThreadPoolExecutor(max_workers=concurrency)
+            handler = _verify_local
+        else:
+            bank = shared_bank.SharedBank()
+            bank.publish(refs)
+            pool = ProcessPoolExecutor(max_workers=concurrency, initializer=shared_bank.init_worker,
+                                       initargs=(bank.name,))
+            handler = _verify_shared
+
+        # Warm up every worker so pool startup is not counted as latency
+        for future in [pool.submit(handler, clips[0], metric) for _ in range(concurrency)]:
+            future.result()
+        cpu_start = _cpu_seconds()
+        start = time.perf_counter()
+
+        clients = [threading.Thread(target=client, args=(pool, handler)) for _ in range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        seconds = time.perf_counter() - start
+
+        # Pool processes report their own CPU time with each result
+        cpu = _cpu_seconds() - cpu_start + sum(worker_cpu)
+        pool.shutdown()
+    finally:
+        _thread_refs = None
+        if bank is not None:
+            bank.close()
+
+    latencies = np.asarray(latencies)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {'executor': executor,
+            'concurrency': concurrency,
+            'requests': len(latencies),
+            'seconds': seconds,
+            'throughput': len(latencies) / seconds,
+            'p50': p50, 'p95': p95, 'p99': p99,
+            'mean': latencies.mean(),
+            'cpu_seconds': cpu,
+            'cpu_utilisation': cpu / seconds / (os.cpu_count() or 1)}
+
+def print_report(reports):
+    print(f'{"executor":>8} {"clients":>7} {"req/s":>8} {"p50 ms":>9} {"p95 ms":>9} '
+          f'{"p99 ms":>9} {"CPU":>6} {"CPU ms/req":>10}')
+    for r in reports:
+        print(f'{r["executor"]:>8} {r["concurrency"]:>7} {r["throughput"]:>8.2f} '
+              f'{r["p50"] * 1e3:>9.1f} {r["p95"] * 1e3:>9.1f} {r["p99"] * 1e3:>9.1f} '
+              f'{r["cpu_utilisation"]:>6.0%} {r["cpu_seconds"] / r["requests"] * 1e3:>10.1f}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='voice_lock.loadtest', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--executor', default='thread,process',
+                        help='comma-separated executors to run: thread, process')
+    parser.add_argument('--concurrency', default='1,2,4',
+                        help='comma-separated numbers of concurrent clients')
+    parser.add_argument('--requests', type=int, default=32, help='requests per run')
+    parser.add_argument('--mix', default='bundled=1,synthetic=1',
+                        help='clip sources with weights: bundled, synthetic')
+    parser.add_argument('--lengths', default='1,3',
+                        help='comma-separated synthetic clip lengths in seconds')
+    parser.add_argument('--metric', choices=sorted(METRICS), default='ncc',
+                        help="similarity metric, 'minsum' takes a few ms per reference")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    cipher = make_cipher()
+    refs = [make_enc_wave(path, cipher) for path in find_ref_samples()]
+    clips = make_requests(args.requests, parse_mix(args.mix),
+                          [float(s) for s in args.lengths.split(',')], seed=args.seed)
+    print(f'{len(clips)} requests against {len(refs)} references, metric {args.metric}, '
+          f'{os.cpu_count()} CPUs')
+
+    reports = []
+    for executor in args.executor.split(','):
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            reports.append(run_load(clips, refs, executor, concurrency, args.metric))
+    print_report(reports)
+
+if __name__ == '__main__':
+    main()
@@ -4,40 +4,56 @@
 
 # System imports
 import functools
-import glob
-import os
 import os.path as osp
 import sys
-import time
+import threading
+import traceback
 
 # Third party imports
+# (tqdm, sounddevice and matplotlib are slow to import and are loaded on first use)
 import numpy as np
-from tqdm import tqdm, trange
-import sounddevice as sd
-from scipy.signal import hilbert
-
-# matplotlib imports
-from matplotlib.backends.backend_qt5agg import (
-    FigureCanvas, NavigationToolbar2QT as NavigationToolbar)
-from matplotlib.figure import Figure
 
 # import PyQt5
-from PyQt5.QtWidgets import QFileDialog, QMessageBox, QProgressBar, QLabel
+from PyQt5.QtWidgets import QActionGroup, QFileDialog, QMessageBox, QProgressBar, QLabel
 from PyQt5.QtCore import QThread, pyqtSignal
-from PyQt5 import uic
 
 # local imports
 from .aes_cipher import AESCipher
+from .consolidate import score_consolidated
+from .deadline import verify_with_deadline
+from .profiling import thread_profile
+from .archive import RecordingArchive
+from .recordings import RecordingWriter
+from .score_cache import ScoreCache
+from .template_cache import TemplateCache
+from .verify import KEY, find_ref_samples, load_quantized_ref, load_ref_consolidation, score
 from .wave_proc import *
 
-# Load and preconfigure GUI from UI file
+def load_ui_type(ui_path):
+    '''Get (Ui_MainWindow, QMainWindow) classes. Use the module pregenerated
+    by `make ui` unless it is missing or older than the UI file'''
+    try:
+        from .gui import mainwindow_ui
+        if osp.getmtime(mainwindow_ui.__file__) < osp.getmtime(ui_path):
+            raise ImportError('Pregenerated UI module is outdated')
+        from PyQt5.QtWidgets import QMainWindow
+        return mainwindow_ui.Ui_MainWindow, QMainWindow
+    except ImportError:
+        from PyQt5 import uic
+        return uic.loadUiType(ui_path)
+
+# Load and preconfigure GUI
 self_wd = osp.abspath(osp.dirname(__file__))
-(Ui_MainWindow, QMainWindow) = uic.loadUiType(osp.join(self_wd, 'gui', 'mainwindow.ui'))
+(Ui_MainWindow, QMainWindow) = load_ui_type(osp.join(self_wd, 'gui', 'mainwindow.ui'))
 
 class MainWindow(QMainWindow):
     """MainWindow inherits QMainWindow"""
 
-    def __init__(self, parent=None):
+    recording_saved = pyqtSignal(str, bool)  # archived path, whether it is a new recording
+
+    def __init__(self, parent=None, metric='minsum', threshold=None, cache_budget=64 * 2**20,
+                 score_cache_dir=None, quantize_bits=None, consolidate_refs=True,
+                 deadline=None):
         QMainWindow.__init__(self, parent)
         self.ui = Ui_MainWindow()
         self.ui.setupUi(self)
@@ -54,66 +70,149 @@ class MainWindow(QMainWindow):
         self.ui.login_button.clicked.connect(self.onStart)
 
         # Initialize AES Cipher
-        self.key = b'Sixteen byte key'
+        self.key = KEY
         self.cipher = AESCipher(key=self.key)
         self.cipher.load_iv(osp.join(self.refs_path, 'iv'))
 
-        # Setup matplotlib plotting widget
-        self.figure = Figure(figsize=(5, 3))
-        self.canvas = FigureCanvas(self.figure)
-        self.toolbar = NavigationToolbar(self.canvas, self)
-
-        # Add plotting widget and toolbar to waveform_view
-        self.ui.main_panel_layout.insertWidget(0, self.toolbar)
-        self.ui.main_panel_layout.insertWidget(0, self.canvas)
+        # Matplotlib plotting widget is created on the first plot
+        self.figure = None
+        self.canvas = None
+        self.toolbar = None
 
         # Encrypt reference WAV samples
-        # encrypt_wavs(dir_in=osp.join(self.wd, 'data/ref_samples_raw'),
-        #              dir_out=osp.join(self.wd, 'data/ref_samples'),
-        #              cipher=self.cipher)
-
-        # Load reference samples of the Master
+        # report = encrypt_wavs(dir_in=osp.join(self.wd, 'data/ref_samples_raw'),
+        #                       dir_out=osp.join(self.wd, 'data/ref_samples'),
+        #                       cipher=self.cipher, incremental=True)
+        # self.log(f'Encrypted {report["encrypted"]}/{report["total"]} samples '
+        #          f'at {report["mb_per_s"]:.1f} MB/s')
+
+        # Load reference samples of the Master through the template cache
+        loader = None
+        if quantize_bits is not None:
+            loader = lambda path: load_quantized_ref(path, self.cipher, quantize_bits)
+        self.templates = TemplateCache(self.cipher, budget=cache_budget, loader=loader)
         self.ref_samples = self.load_ref_samples(ref_dir=self.refs_path)
+
+        # Score logins against medoids of the references first
+        self.consolidation = None
+        if consolidate_refs:
+            self.consolidation = load_ref_consolidation(self.ref_samples, self.cipher,
+                                                        self.refs_path, quantize_bits)
+            self.log(f'References consolidated into {len(self.consolidation)} medoids')
         self.test_sample = None
 
+        # Recordings are archived and indexed in background. The archive
+        # database is created with the first recording
+        self.archive = RecordingArchive(self.recs_path)
+        self.recording_saved.connect(self.onRecordingSaved)
+        self.recorder = RecordingWriter(self.recs_path, archive=self.archive,
+                                        on_saved=self.recording_saved.emit)
+        self.recorded = None  # (samples, rate) when the test sample was recorded
+
+        # Memoize comparison scores, optionally on disk
+        self.score_cache = ScoreCache(cache_dir=score_cache_dir, cipher=self.cipher)
+
         # self.store_secret('EASY OTL 15')
         # self.show_secret()
 
         # Setup progress bar
-        self.ui.progress_bar.setRange(0, len(self.ref_samples))
+        self.ui.progress_bar.setRange(0, len(self.ref_samples) * TaskThread.STEPS)
 
         # Setup QThread'ing procedure for comparison
+        self.job_id = None
         self.compare_task = TaskThread()
         self.compare_task.update_comparison.connect(self.onProgress)
         self.compare_task.comparison_completed.connect(self.onFinish)
+        self.compare_task.comparison_cancelled.connect(self.onCancel)
+        self.compare_task.comparison_failed.connect(self.onFail)
+        self.compare_task.start()
+
+        # Optional latency budget of a login in seconds
+        self.deadline = deadline
 
-        # Set classification cut-off threshold
-        self.threshold = 0.6
+        # Set similarity metric and classification cut-off threshold
+        self.metric = metric
+        self.threshold = default_threshold(metric) if threshold is None else threshold
+        self.setup_settings_menu()
 
     def __del__(self):
         self.ui = None
 
+    def closeEvent(self, event):
+        self.compare_task.stop()
+        self.compare_task.wait()
+        self.recorder.close()
+        self.archive.close()
+        QMainWindow.closeEvent(self, event)
+
     def log(self, text, debug=True):
         self.ui.console.append(text)
         if debug:
             print(text)
 
-    def load_ref_samples(self, ref_dir='./data/ref_samples'):
+    def load_ref_samples(self, ref_dir='./data/ref_samples', speaker='Master'):
         self.log('Searching for reference samples...')
 
-        enc_samples = glob.glob(osp.join(ref_dir, '*.wav.enc'))
+        enc_samples = find_ref_samples(ref_dir)
         self.log(f'Found {len(enc_samples)} reference samples in {osp.basename(ref_dir)} directory.')
 
-        ref_samples = [make_enc_wave(sample, self.cipher) for sample in enc_samples]
+        # The Master is used on every login, so keep the templates resident
+        self.templates.add_speaker(speaker, enc_samples)
+        self.templates.pin(speaker)
         self.log(f'Reference samples loaded successfully')
 
-        return ref_samples
+        return self.templates.templates(speaker)
 
     def load_test_sample(self, test_path):
-        self.test_sample = make_wave(test_path)
+        self.load_test_data(read_wav(test_path))
+
+    def load_test_data(self, data):
+        '''Use decoded samples as the test sample'''
+        # Comparison of the previous sample is stale now
+        if self.job_id is not None:
+            self.compare_task.cancel()
+            self.job_id = None
+            self.ui.progress_bar.setValue(0)
+
+        self.recorded = None
+        self.test_sample = default_pipeline()(data)
         self.display_waveform(self.test_sample)
         self.log('Test sample waveform loaded.')
 
+    def setup_settings_menu(self):
+        '''Add Settings menu with similarity metric selection'''
+        settings_menu = self.ui.menuBar.addMenu('Settings')
+        metric_menu = settings_menu.addMenu('Similarity metric')
+
+        self.metric_group = QActionGroup(self)
+        self.metric_group.setExclusive(True)
+        for name in METRICS:
+            action = metric_menu.addAction(name)
+            action.setCheckable(True)
+            action.setChecked(name == self.metric)
+            action.triggered.connect(lambda checked, name=name: self.set_metric(name))
+            self.metric_group.addAction(action)
+
+    def set_metric(self, metric):
+        '''Switch similarity metric along with its default threshold'''
+        self.metric = metric
+        self.threshold = default_threshold(metric)
+        self.log(f'Similarity metric set to {metric} (threshold {self.threshold})')
+
+    def setup_canvas(self):
+        '''Setup matplotlib plotting widget'''
+        from matplotlib.backends.backend_qt5agg import (
+            FigureCanvas, NavigationToolbar2QT as NavigationToolbar)
+        from matplotlib.figure import Figure
+
+        self.figure = Figure(figsize=(5, 3))
+        self.canvas = FigureCanvas(self.figure)
+        self.toolbar = NavigationToolbar(self.canvas, self)
+
+        # Add plotting widget and toolbar to waveform_view
+        self.ui.main_panel_layout.insertWidget(0, self.toolbar)
+        self.ui.main_panel_layout.insertWidget(0, self.canvas)
+
     # === QPushButton SLOTS ===
 
     def _load_button_clicked(self):
@@ -131,6 +230,8 @@ class MainWindow(QMainWindow):
             self.load_test_sample(fpath_load)
 
     def _record_button_clicked(self):
+        import sounddevice as sd
+
         fs=44100
         duration=1.5
         self.log('Recording Audio: 4s')
@@ -141,19 +242,17 @@ class MainWindow(QMainWindow):
         sd.play(rec_wave, fs)
         sd.wait()
 
-        # Save waveform
-        recordings = len(glob.glob(osp.join(self.recs_path, 'recording*.wav')))
-        path = osp.join(self.recs_path, 'recording_%d.wav' % recordings)
-        with open(path, 'wb') as rec_file:
-            siw.write(rec_file, 44100, rec_wave)
-
-        self.log(f'Waveform is saved as {path}')
-        self.load_test_sample(path)
+        # Process the recording from memory, archiving it with its envelope in background
+        self.load_test_data(rec_wave)
+        self.recorded = (rec_wave, fs)
+        self.recorder.save(rec_wave, fs, self.test_sample)
 
     # === Waveform processing and visualisation SLOTS ===
 
     def compare(self):
-        conf = functools.reduce((lambda r, smp: r + corr_tuple(self.test_sample, smp)),
+        from tqdm import tqdm
+
+        conf = functools.reduce((lambda r, smp: r + self.score_cache.score(self.test_sample, smp, self.metric)),
                                tqdm(self.ref_samples),
                                0) / len(self.ref_samples)
 
@@ -170,6 +269,8 @@ class MainWindow(QMainWindow):
         return conf
 
     def display_waveform(self, wave_data):
+        if self.canvas is None:
+            self.setup_canvas()
 
         ax = self.figure.add_subplot(111)
 
@@ -177,9 +278,9 @@ class MainWindow(QMainWindow):
         ax.clear()
 
         # plot data
-        if len(wave_data) == 2:
-            ax.plot(np.arange(len(wave_data[0])), wave_data[0])
-            ax.plot(np.arange(len(wave_data[1])), wave_data[1])
+        if isinstance(wave_data, tuple):  # envelope channels
+            for channel in wave_data:
+                ax.plot(np.arange(len(channel)), channel)
         else:
             ax.plot(np.arange(len(wave_data)), wave_data)
 
@@ -202,17 +303,47 @@ class MainWindow(QMainWindow):
     ### ~~~ QThread'ing merhods for comparison
 
     def onStart(self):
-        '''Start of comparison'''
+        '''Start of comparison, superseding the running one'''
+        if self.test_sample is None:
+            self.log('Load or record a voice sample first.')
+            return
+
         self.ui.progress_bar.setValue(0)
-        self.compare_task.set_args(self.ref_samples, self.test_sample)
-        self.compare_task.start()
+        self.job_id = self.compare_task.submit(self.ref_samples, self.test_sample, self.metric,
+                                               self.score_cache, self.consolidation,
+                                               self.threshold, self.deadline)
 
-    def onProgress(self, i):
+    def onProgress(self, job_id, value):
         '''Update progress bar for comparison'''
-        self.ui.progress_bar.setValue(i)
+        if job_id == self.job_id:
+            self.ui.progress_bar.setValue(value)
+
+    def onRecordingSaved(self, path, new):
+        if new:
+            self.log(f'Waveform saved as {path}')
+        else:
+            self.log(f'Recording is identical to {path}, not saved again')
+
+    def onCancel(self, job_id):
+        self.log(f'Comparison #{job_id} cancelled')
+
+    def onFail(self, job_id, message):
+        if job_id == self.job_id:
+            self.job_id = None
+            self.ui.progress_bar.setValue(0)
+        self.log(f'Comparison #{job_id} failed: {message}')
 
-    def onFinish(self, conf):
+    def onFinish(self, job_id, conf):
+        if job_id != self.job_id:
+            return
+        self.job_id = None
         self.log(f'Confidence is {conf}')
+        result = self.compare_task.deadline_result
+        if self.deadline is not None and result is not None:
+            self.log(f'Fidelity {result.level} reached in {result.seconds * 1e3:.0f} ms'
+                     + (', cut short by deadline' if result.cut_short else ''))
+        if self.recorded is not None:
+            self.recorder.record_score(*self.recorded, conf, self.metric)
 
         if conf > self.threshold:
             self.log('Greetings, Master')
@@ -223,21 +354,103 @@ class MainWindow(QMainWindow):
             self.log('The secret remains hidden.')
 
 class TaskThread(QThread):
-    update_comparison = pyqtSignal(int)
-    comparison_completed = pyqtSignal(np.float64)
+    '''Worker running one comparison job at a time.
 
-    def set_args(self, ref_samples, test_sample):
-        self.ref_samples = ref_samples
-        self.test_sample = test_sample
+    Every submitted job gets an id. A newer job supersedes the running one,
+    which is cancelled cooperatively from inside the comparison, so stale
+    work stops within a fraction of a reference.'''
 
-    def run(self):
-        conf = 0
-        for i in trange(len(self.ref_samples)):
-            conf += corr_tuple(self.test_sample, self.ref_samples[i])
-            self.update_comparison.emit(i+1)
+    STEPS = 100  # progress steps per reference
+
+    update_comparison = pyqtSignal(int, int)      # job id, progress steps done
+    comparison_completed = pyqtSignal(int, float)  # job id, confidence
+    comparison_cancelled = pyqtSignal(int)        # job id
+    comparison_failed = pyqtSignal(int, str)      # job id, error message
 
-        conf /= len(self.ref_samples)
-        self.comparison_completed.emit(conf)
+    def __init__(self, parent=None):
+        QThread.__init__(self, parent)
+        self._condition = threading.Condition()
+        self._next_id = 0
+        self._latest_id = 0   # jobs with other ids are stale
+        self._pending = None
+        self._stopped = False
+        self.deadline_result = None  # result of the last deadline-bounded job
+
+    def submit(self, ref_samples, test_sample, metric='minsum', score_cache=None,
+               consolidation=None, threshold=None, deadline=None):
+        '''Queue comparison job, superseding any older one. Returns job id.
+        With `consolidation` the medoids are scored first and the rest of
+        the references only near `threshold`. With `deadline` in seconds
+        the job answers in time at the best fidelity reached'''
+        with self._condition:
+            self._next_id += 1
+            self._latest_id = self._next_id
+            self._pending = (self._next_id, ref_samples, test_sample, metric, score_cache,
+                             consolidation, threshold, deadline)
+            self._condition.notify()
+            return self._next_id
+
+    def cancel(self):
+        '''Cancel running and pending jobs'''
+        with self._condition:
+            self._latest_id = None
+            self._pending = None
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._latest_id = None
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                job, self._pending = self._pending, None
+
+            job_id = job[0]
+            try:
+                with thread_profile():
+                    conf = self.run_job(*job)
+            except Cancelled:
+                self.comparison_cancelled.emit(job_id)
+            except Exception as error:
+                # An exception escaping QThread.run aborts the application
+                traceback.print_exc()
+                self.comparison_failed.emit(job_id, f'{type(error).__name__}: {error}')
+            else:
+                self.comparison_completed.emit(job_id, conf)
+
+    def run_job(self, job_id, ref_samples, test_sample, metric, score_cache, consolidation,
+                threshold, deadline):
+        total = len(ref_samples) * self.STEPS
+        progress = [0]
+
+        def check(done):
+            if self._latest_id != job_id:
+                raise Cancelled
+            steps = int(done * total)
+            if steps > progress[0]:
+                progress[0] = steps
+                self.update_comparison.emit(job_id, steps)
+
+        if deadline is not None:
+            subset = consolidation.medoids if consolidation is not None else None
+            result = verify_with_deadline(test_sample, ref_samples, deadline, metric, threshold,
+                                          subset=subset, check=check)
+            self.deadline_result = result
+            # Fail closed when not even the cheapest level was reached
+            conf = result.confidence if result.confidence is not None else 0.0
+        elif consolidation is None:
+            conf = score(test_sample, ref_samples, metric, score_cache=score_cache, check=check)
+        else:
+            conf, _, _ = score_consolidated(test_sample, ref_samples, consolidation, threshold,
+                                            metric, score_cache=score_cache, check=check)
+        self.update_comparison.emit(job_id, total)
+        return conf
 
 
 #-----------------------------------------------------#
@@ -0,0 +1,353 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Reusable preprocessing pipeline with preallocated work buffers.
+
+The stages are the only implementation of the preprocessing DSP. They
+reproduce the original sample-by-sample normalize, denoise and envelope
+loops, but run in place on buffers owned by the pipeline, so processing
+clips of the same size again does no large allocations.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+### ~~~ Stages ~~~ ###
+# Each stage is called as `stage(data, pipeline)` and returns the data for
+# the next stage. Stages may use `pipeline.buffer` for their work arrays.
+
+def mixdown(data, pipeline):
+    '''Copy samples into the float work buffer, averaging stereo channels'''
+    wave = pipeline.buffer('wave', len(data))
+    if data.ndim == 2:
+        np.mean(data, axis=1, out=wave)
+    else:
+        np.copyto(wave, data, casting='unsafe')
+    return wave
+
+def normalize(wave, pipeline):
+    wave /= np.amax(wave)
+    return wave
+
+# Denoise is the recursive filter y[i] = w[i] * (x[i] - 0.9 * y[i-1]) with
+# a window w of period 180, starting from y[-1] = x[-1]. Because the
+# coefficients repeat every period, the response within a period is a fixed
+# 180x180 matrix, and periods are chained by a scalar recursion.
+DENOISE_PERIOD = 180
+_denoise_window = 0.54 - 0.46 * np.cos((np.arange(DENOISE_PERIOD) - 6) * 2 * np.pi / DENOISE_PERIOD)
+_denoise_coef = -0.9 * _denoise_window
+
+# Response to the value carried into a period
+_denoise_carry = np.cumprod(_denoise_coef)
+
+# Zero-state response to the input within a period (lower triangular)
+_denoise_matrix = np.zeros((DENOISE_PERIOD, DENOISE_PERIOD))
+for _j in range(DENOISE_PERIOD):
+    _denoise_matrix[_j, _j] = 1
+    if _j:
+        _denoise_matrix[_j, :_j] = _denoise_matrix[_j - 1, :_j] * _denoise_coef[_j]
+_denoise_matrix_t = np.ascontiguousarray(_denoise_matrix.T)
+
+def denoise(wave, pipeline, last=None):
+    '''Denoise in place. `last` is the output preceding `wave`, which is the
+    last sample of `wave` for a whole clip. Streams are denoised block by
+    block, passing the previous block's last output'''
+    n = len(wave)
+    if n == 0:
+        return wave
+    periods = -(-n // DENOISE_PERIOD)
+    size = periods * DENOISE_PERIOD
+    if last is None:
+        last = wave[-1]
+
+    # Windowed input, zero padded to whole periods
+    padded = pipeline.buffer('denoise_input', size)
+    np.multiply(wave, pipeline.tile('denoise_window', _denoise_window, n), out=padded[:n])
+    padded[n:] = 0
+    padded = padded.reshape(periods, DENOISE_PERIOD)
+
+    response = pipeline.buffer('denoise_response', size).reshape(periods, DENOISE_PERIOD)
+    np.matmul(padded, _denoise_matrix_t, out=response)
+
+    # Values carried into each period
+    carry = pipeline.buffer('denoise_carry', periods)
+    carry[0] = last
+    gain = _denoise_carry[-1]
+    for k in range(1, periods):
+        carry[k] = response[k - 1, -1] + gain * carry[k - 1]
+
+    np.multiply(carry[:, None], _denoise_carry, out=padded)
+    padded += response
+    wave[:] = padded.ravel()[:n]
+    return wave
+
+def envelope(wave, pipeline, block=75):
+    '''Block means of the positive and the negated negative samples.
+    Samples are grouped by their rank among samples of the same sign,
+    which avoids compacting them into new arrays'''
+    n = len(wave)
+    member = pipeline.buffer('member', n, dtype=np.intp)
+    rank = pipeline.buffer('rank', n, dtype=np.intp)
+    weights = pipeline.buffer('weights', n)
+
+    parts = []
+    for sign in (1, -1):
+        # Members of this sign and how many of them precede each sample
+        if sign > 0:
+            np.greater_equal(wave, 0, out=member, casting='unsafe')
+            np.maximum(wave, 0, out=weights)
+        else:
+            np.less(wave, 0, out=member, casting='unsafe')
+            np.minimum(wave, 0, out=weights)
+            np.negative(weights, out=weights)
+        np.cumsum(member, out=rank)
+        count = rank[-1] if n else 0
+        rank -= member
+        rank //= block
+
+        blocks = count // block
+        sums = np.bincount(rank, weights=weights, minlength=blocks + 1)[:blocks]
+        parts.append(sums / block)
+
+    return tuple(parts)
+
+HILBERT_HOP = 150  # samples per frame, as one 75-sample block of each sign
+
+def hilbert_envelope(wave, pipeline, hop=HILBERT_HOP):
+    '''Magnitude of the analytic signal, low-passed by averaging over frames
+    of `hop` samples. Returns a tuple with the single channel, so templates
+    stay tuples of channels'''
+    n = len(wave)
+    size = 1 << max(n - 1, 0).bit_length()
+
+    # Analytic signal: drop negative frequencies, double positive ones
+    spectrum = np.fft.fft(wave, size)
+    spectrum[1:size // 2] *= 2
+    spectrum[size // 2 + 1:] = 0
+    magnitude = pipeline.buffer('magnitude', n)
+    np.abs(np.fft.ifft(spectrum)[:n], out=magnitude)
+
+    frames = n // hop
+    return (magnitude[:frames * hop].reshape(frames, hop).mean(1),)
+
+# Envelope engines selectable by name
+ENVELOPES = {
+    'block': envelope,
+    'hilbert': hilbert_envelope,
+}
+
+DEFAULT_STAGES = (
+    ('mixdown', mixdown),
+    ('normalize', normalize),
+    ('denoise', denoise),
+    ('envelope', envelope),
+)
+
+### ~~~ Batches ~~~ ###
+# Batch stages process many clips at once. Clips are packed into rows of a
+# zero padded 2-D array, with their lengths in a vector, and every stage
+# works on the whole array, called as `stage(batch, lengths, pipeline)`.
+# Templates match those of the single clip stages.
+
+def _batch_buffer(pipeline, name, shape, dtype=np.float64):
+    return pipeline.buffer(name, shape[0] * shape[1], dtype).reshape(shape)
+
+def pack_batch(clips, pipeline):
+    '''Mix down decoded clips into a zero padded float array, with rows
+    padded to whole denoise periods. Returns (batch, lengths)'''
+    clips = [np.asarray(data) for data in clips]
+    lengths = np.array([len(data) for data in clips], dtype=np.intp)
+    width = -(-lengths.max(initial=0) // DENOISE_PERIOD) * DENOISE_PERIOD
+    batch = _batch_buffer(pipeline, 'batch', (len(clips), width))
+    for row, data in zip(batch, clips):
+        if data.ndim == 2:
+            np.mean(data, axis=1, out=row[:len(data)])
+        else:
+            np.copyto(row[:len(data)], data, casting='unsafe')
+        row[len(data):] = 0
+    return batch, lengths
+
+def normalize_batch(batch, lengths, pipeline):
+    peaks = batch.max(1)
+    # Padding counts as a zero sample, which only matters without positive samples
+    for k in np.flatnonzero(peaks <= 0):
+        peaks[k] = np.amax(batch[k, :lengths[k]])
+    batch /= peaks[:, None]
+    return batch
+
+def denoise_batch(batch, lengths, pipeline):
+    '''Denoise every clip in place, as `denoise` with `last=None`. Samples
+    past the end of a clip are left undefined'''
+    clips, width = batch.shape
+    if width == 0:
+        return batch
+    periods = width // DENOISE_PERIOD
+    last = batch[np.arange(clips), np.maximum(lengths - 1, 0)]
+
+    padded = batch.reshape(clips * periods, DENOISE_PERIOD)
+    padded *= _denoise_window
+    response = _batch_buffer(pipeline, 'batch_response', padded.shape)
+    np.matmul(padded, _denoise_matrix_t, out=response)
+    response = response.reshape(clips, periods, DENOISE_PERIOD)
+
+    # Values carried into each period. Iterating the recursion on all periods
+    # at once reaches the sequential result in a few steps, because the
+    # carry decays by a factor of ~1e-78 per period
+    carry = np.empty((clips, periods))
+    carry[:, 0] = last
+    ends = response[:, :-1, -1]
+    carry[:, 1:] = ends
+    gain = _denoise_carry[-1]
+    for _ in range(periods):
+        step = ends + gain * carry[:, :-1]
+        if np.array_equal(step, carry[:, 1:], equal_nan=True):
+            break
+        carry[:, 1:] = step
+
+    np.multiply(carry[:, :, None], _denoise_carry, out=batch.reshape(response.shape))
+    batch += response.reshape(clips, width)
+    return batch
+
+def envelope_batch(batch, lengths, pipeline, block=75):
+    '''Templates of `envelope` for every clip. Samples past the end of a
+    clip fall into bins after its last whole block, which are dropped'''
+    clips, width = batch.shape
+    stride = width // block + 1  # bins per clip
+    ends = np.maximum(lengths - 1, 0)
+    member = _batch_buffer(pipeline, 'batch_member', batch.shape, np.intp)
+    rank = _batch_buffer(pipeline, 'batch_rank', batch.shape, np.intp)
+    weights = _batch_buffer(pipeline, 'batch_weights', batch.shape)
+
+    parts = []
+    for sign in (1, -1):
+        if sign > 0:
+            np.greater_equal(batch, 0, out=member, casting='unsafe')
+            np.maximum(batch, 0, out=weights)
+        else:
+            np.less(batch, 0, out=member, casting='unsafe')
+            np.minimum(batch, 0, out=weights)
+            np.negative(weights, out=weights)
+        np.cumsum(member, axis=1, out=rank)
+        counts = np.where(lengths > 0, rank[np.arange(clips), ends], 0)
+        rank -= member
+        rank //= block
+        parts.append([np.bincount(rank[k], weights=weights[k],
+                                  minlength=stride)[:counts[k] // block] / block
+                      for k in range(clips)])
+
+    return [tuple(channels) for channels in zip(*parts)]
+
+def hilbert_envelope_batch(batch, lengths, pipeline, hop=HILBERT_HOP):
+    '''Templates of `hilbert_envelope` for every clip. Clips that share an
+    FFT size are transformed together'''
+    templates = [None] * len(batch)
+    sizes = np.array([1 << max(int(n) - 1, 0).bit_length() for n in lengths])
+    for size in np.unique(sizes):
+        rows = np.flatnonzero(sizes == size)
+        signal = batch[rows, :min(size, batch.shape[1])]
+        signal[np.arange(signal.shape[1]) >= lengths[rows, None]] = 0
+        spectrum = np.fft.fft(signal, size, axis=1)
+        spectrum[:, 1:size // 2] *= 2
+        spectrum[:, size // 2 + 1:] = 0
+        magnitude = np.abs(np.fft.ifft(spectrum, axis=1))
+        for row, signal in zip(rows, magnitude):
+            frames = lengths[row] // hop
+            templates[row] = (signal[:frames * hop].reshape(frames, hop).mean(1),)
+    return templates
+
+BATCH_ENVELOPES = {
+    'block': envelope_batch,
+    'hilbert': hilbert_envelope_batch,
+}
+
+def process_batch(clips, pipeline=None):
+    '''Templates of decoded `clips`, preprocessed together with the
+    envelope engine of `pipeline`, whose work buffers are used'''
+    pipeline = pipeline or default_pipeline()
+    if not len(clips):
+        return []
+    batch, lengths = pack_batch(clips, pipeline)
+    normalize_batch(batch, lengths, pipeline)
+    denoise_batch(batch, lengths, pipeline)
+    return BATCH_ENVELOPES[pipeline.engine or _engine](batch, lengths, pipeline)
+
+### ~~~ Pipeline ~~~ ###
+
+class Pipeline(object):
+    '''Preprocessing pipeline turning decoded WAV samples into a template.
+
+    Owns work buffers that are grown on demand and reused across calls,
+    so a pipeline must not be shared between threads. Stages can be
+    replaced with `set_stage` and are timed individually.'''
+
+    def __init__(self, stages=DEFAULT_STAGES):
+        self.stages = list(stages)
+        self.engine = None
+        self.timings = {name: 0.0 for name, _ in self.stages}
+        self.calls = 0
+        self._buffers = {}
+
+    def __call__(self, data):
+        data = np.asarray(data)
+        for name, stage in self.stages:
+            start = time.perf_counter()
+            data = stage(data, self)
+            self.timings[name] += time.perf_counter() - start
+        self.calls += 1
+        return data
+
+    def set_stage(self, name, stage):
+        '''Replace stage `name` with `stage(data, pipeline)`'''
+        names = [stage_name for stage_name, _ in self.stages]
+        self.stages[names.index(name)] = (name, stage)
+
+    def buffer(self, name, size, dtype=np.float64):
+        '''View of `size` elements of the work buffer `name`'''
+        buf = self._buffers.get(name)
+        if buf is None or buf.dtype != dtype or len(buf) < size:
+            buf = self._buffers[name] = np.empty(size, dtype=dtype)
+        return buf[:size]
+
+    def tile(self, name, pattern, size):
+        '''View of `size` elements of `pattern` repeated, cached as `name`'''
+        buf = self._buffers.get(name)
+        if buf is None or len(buf) < size:
+            buf = self._buffers[name] = np.resize(pattern, size)
+        return buf[:size]
+
+    def reset_timings(self):
+        self.timings = {name: 0.0 for name, _ in self.stages}
+        self.calls = 0
+
+def make_pipeline(engine='block'):
+    '''Pipeline using envelope `engine` from `ENVELOPES`'''
+    if engine not in ENVELOPES:
+        raise ValueError(f'Unknown envelope engine {engine!r}, expected one of {sorted(ENVELOPES)}')
+    pipeline = Pipeline()
+    pipeline.set_stage('envelope', ENVELOPES[engine])
+    pipeline.engine = engine
+    return pipeline
+
+_local = threading.local()
+_engine = 'block'
+
+def set_envelope_engine(engine):
+    '''Envelope engine of the default pipelines of all threads'''
+    global _engine
+    if engine not in ENVELOPES:
+        raise ValueError(f'Unknown envelope engine {engine!r}, expected one of {sorted(ENVELOPES)}')
+    _engine = engine
+
+def get_envelope_engine():
+    return _engine
+
+def default_pipeline():
+    '''Pipeline of the calling thread'''
+    pipeline = getattr(_local, 'pipeline', None)
+    if pipeline is None or pipeline.engine != _engine:
+        pipeline = _local.pipeline = make_pipeline(_engine)
+    return pipeline
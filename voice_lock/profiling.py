@@ -0,0 +1,185 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+On-demand profiling of a whole run.
+
+Two profilers run together. cProfile measures the main thread and every
+thread that wraps its work in `thread_profile()`, such as the comparison
+worker. From Python 3.12 cProfile runs on `sys.monitoring`, where only
+one profiler can be enabled and it sees every thread, so the main one
+covers the workers too. A sampling thread records the stacks of all threads, including
+the Qt event loop, every `interval` seconds. Optionally tracemalloc traces
+allocations of the same run.
+
+`Profiler.stop` writes to the output directory:
+    profile.pstats      cProfile stats of all profiled threads merged
+    profile.txt         the same stats sorted by cumulative time
+    stacks.collapsed    sampled stacks in collapsed format for flame
+                        graph tools (flamegraph.pl, speedscope, inferno)
+    allocations.txt     top allocation sites, with `memory=True`
+"""
+
+import collections
+import cProfile
+import os
+import os.path as osp
+import pstats
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+_active = None
+
+def active():
+    '''Running `Profiler` or None'''
+    return _active
+
+# cProfile profiles all threads at once and only one profiler can be enabled
+SHARED_PROFILE = sys.version_info >= (3, 12)
+
+@contextmanager
+def thread_profile():
+    '''Profile the calling thread with cProfile while the active profiler
+    runs. Does nothing when there is none, or when the main profile already
+    covers every thread'''
+    profiler = _active
+    if profiler is None or SHARED_PROFILE:
+        yield
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Another profiling tool is active, run unprofiled
+        yield
+        return
+    try:
+        yield
+    finally:
+        profile.disable()
+        profiler.add_profile(profile)
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({osp.basename(code.co_filename)}:{code.co_firstlineno})'
+
+class Profiler(object):
+    '''Deterministic and sampling profiler of all threads of a run'''
+
+    def __init__(self, out_dir, interval=0.005, memory=False, top=50):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.memory = memory
+        self.top = top
+
+        self.stacks = collections.Counter()
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._main = cProfile.Profile()
+        self._sampler = threading.Thread(target=self._sample, name='ProfileSampler', daemon=True)
+
+    def start(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError('Another profiler is running')
+        _active = self
+        if self.memory:
+            tracemalloc.start(25)
+        self._sampler.start()
+        self._main.enable()
+        return self
+
+    def stop(self):
+        '''Stop profiling and write the reports. Returns their paths'''
+        global _active
+        self._main.disable()
+        self._stopped.set()
+        self._sampler.join()
+        _active = None
+        self.add_profile(self._main)
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        paths = []
+        if self.memory:
+            # Snapshot before writing the other reports allocates anything
+            paths.append(self._write_allocations())
+            tracemalloc.stop()
+        paths += [self._write_stats(), self._write_text(), self._write_stacks()]
+        return paths
+
+    def add_profile(self, profile):
+        with self._lock:
+            self._profiles.append(profile)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # === Sampling ===
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f'Thread-{ident}'))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    # === Reports ===
+
+    def _path(self, name):
+        return osp.join(self.out_dir, name)
+
+    def _stats(self, stream=None):
+        with self._lock:
+            stats = pstats.Stats(self._profiles[0], stream=stream)
+            for profile in self._profiles[1:]:
+                stats.add(profile)
+        return stats
+
+    def _write_stats(self):
+        path = self._path('profile.pstats')
+        self._stats().dump_stats(path)
+        return path
+
+    def _write_text(self):
+        path = self._path('profile.txt')
+        with open(path, 'w') as f:
+            self._stats(stream=f).sort_stats('cumulative').print_stats(self.top)
+        return path
+
+    def _write_stacks(self):
+        path = self._path('stacks.collapsed')
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+    def _write_allocations(self):
+        path = self._path('allocations.txt')
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ])
+        with open(path, 'w') as f:
+            f.write(f'peak traced memory {tracemalloc.get_traced_memory()[1] / 2**20:.1f} MB\n\n')
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                f.write(f'{stat}\n')
+            f.write('\nlargest allocation tracebacks\n')
+            for stat in snapshot.statistics('traceback')[:5]:
+                f.write(f'\n{stat.size / 1024:.1f} KiB in {stat.count} blocks\n')
+                f.write('\n'.join(stat.traceback.format()) + '\n')
+        return path
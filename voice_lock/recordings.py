@@ -0,0 +1,110 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Background archival of recorded voice samples.
+
+Recordings are processed straight from memory. Writing them to
+`recording_N.wav` happens on a writer thread, so logins never wait for
+the disk. Indices come from a counter seeded once from the highest index
+already on disk, instead of counting the directory on every recording.
+With a `RecordingArchive` the writer also indexes every recording, skips
+duplicates and stores scores in submission order. The outcome of every
+save is reported to `on_saved` from the writer thread.
+"""
+
+import os
+import os.path as osp
+import queue
+import re
+import sqlite3
+import threading
+
+import scipy.io.wavfile as siw
+
+from .wave_proc import _atomic_write
+
+RECORDING_PATTERN = re.compile(r'recording_(\d+)\.wav$')
+
+def next_recording_index(rec_dir):
+    '''Index following the highest `recording_N.wav` in `rec_dir`'''
+    if not osp.isdir(rec_dir):
+        return 0
+    indices = [int(match.group(1)) for match in map(RECORDING_PATTERN.match, os.listdir(rec_dir))
+               if match]
+    return max(indices, default=-1) + 1
+
+class RecordingWriter(object):
+    '''Writes recordings to `rec_dir` on a daemon thread in submission order'''
+
+    def __init__(self, rec_dir, on_saved=None, archive=None):
+        self.rec_dir = rec_dir
+        # Called as on_saved(path, new) from the writer thread. For a
+        # duplicate `path` is the archived recording with the same samples
+        self.on_saved = on_saved
+        self.archive = archive
+        self._index = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='RecordingWriter', daemon=True)
+        self._thread.start()
+
+    def allocate(self):
+        '''Reserve path of the next recording'''
+        with self._lock:
+            if self._index is None:
+                os.makedirs(self.rec_dir, exist_ok=True)
+                self._index = next_recording_index(self.rec_dir)
+            path = osp.join(self.rec_dir, 'recording_%d.wav' % self._index)
+            self._index += 1
+            return path
+
+    def save(self, data, sample_rate, template=None):
+        '''Queue `data` for writing and return the path it will be saved to.
+        `template` is cached in the archive, if there is one'''
+        path = self.allocate()
+        self._queue.put(lambda: self._write(path, data, sample_rate, template))
+        return path
+
+    def record_score(self, data, sample_rate, score, metric):
+        '''Queue storing `score` of recording `data` in the archive'''
+        if self.archive is not None:
+            self._queue.put(lambda: self._record_score(data, sample_rate, score, metric))
+
+    def flush(self):
+        '''Wait until all queued recordings are written'''
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                item()
+            except (OSError, sqlite3.Error) as error:
+                print(f'Failed to save recording: {error}')
+            finally:
+                self._queue.task_done()
+
+    def _write(self, path, data, sample_rate, template):
+        new = True
+        if self.archive is None:
+            _atomic_write(path, lambda f: siw.write(f, sample_rate, data))
+        else:
+            recording, new = self.archive.add(data, sample_rate, path, template)
+            path = recording.path
+        if self.on_saved is not None:
+            self.on_saved(path, new)
+        elif not new:
+            print(f'Recording is identical to {path}, not saved again')
+
+    def _record_score(self, data, sample_rate, score, metric):
+        recording = self.archive.lookup(data, sample_rate)
+        if recording is not None:
+            self.archive.record_score(recording.id, score, metric)
@@ -0,0 +1,131 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Content-addressed memoization of template comparison scores
+"""
+
+import hashlib
+import json
+import os
+import os.path as osp
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .wave_proc import PIPELINE, Pyramid, _atomic_write, corr_tuple
+
+def template_digest(template):
+    '''SHA-256 hex digest of template contents'''
+    sha = hashlib.sha256()
+    for channel in template:
+        data = np.ascontiguousarray(np.asarray(channel, dtype=np.float64))
+        sha.update(len(data).to_bytes(8, 'little'))
+        sha.update(data.tobytes())
+        if isinstance(channel, Pyramid):
+            sha.update(repr(channel.blocks).encode())
+    return sha.hexdigest()
+
+class ScoreCache(object):
+    '''Memoizes `corr_tuple` results by content hashes of both templates,
+    the metric with its parameters and the pipeline settings.
+
+    Keeps up to `max_entries` scores in memory. If `cache_dir` is given,
+    scores are also stored there encrypted with `cipher`.'''
+
+    def __init__(self, max_entries=4096, cache_dir=None, cipher=None, settings=PIPELINE):
+        if cache_dir is not None and cipher is None:
+            raise ValueError('On-disk score cache needs a cipher')
+
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.cipher = cipher
+        self.settings = json.dumps(settings, sort_keys=True)
+
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, test, ref, metric='minsum', **params):
+        '''Cache key of comparing `test` with `ref` by `metric`'''
+        sha = hashlib.sha256()
+        sha.update(template_digest(test).encode())
+        sha.update(template_digest(ref).encode())
+        sha.update(json.dumps([metric, params], sort_keys=True).encode())
+        sha.update(self.settings.encode())
+        return sha.hexdigest()
+
+    def score(self, test, ref, metric='minsum', check=None, **params):
+        '''`corr_tuple(test, ref, metric)` served from the cache when possible'''
+        key = self.key(test, ref, metric, **params)
+        score = self.get(key)
+        if score is None:
+            score = float(corr_tuple(test, ref, metric, check=check, **params))
+            self.put(key, score)
+        return score
+
+    def get(self, key):
+        with self._lock:
+            if key in self._scores:
+                self.hits += 1
+                self._scores.move_to_end(key)
+                return self._scores[key]
+
+        score = self._load(key)
+        with self._lock:
+            if score is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self._remember(key, score)
+        return score
+
+    def put(self, key, score):
+        with self._lock:
+            self._remember(key, score)
+        self._store(key, score)
+
+    def clear(self):
+        with self._lock:
+            self._scores.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._scores),
+                    'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses}
+
+    def _remember(self, key, score):
+        self._scores[key] = score
+        self._scores.move_to_end(key)
+        while len(self._scores) > self.max_entries:
+            self._scores.popitem(last=False)
+
+    # === On-disk tier ===
+
+    def _path(self, key):
+        return osp.join(self.cache_dir, key + '.score')
+
+    def _load(self, key):
+        if self.cache_dir is None or not osp.exists(self._path(key)):
+            return None
+        try:
+            entry = json.loads(self.cipher.load_data(self._path(key)))
+        except (ValueError, UnicodeDecodeError):
+            # Written with another key or damaged, score it again
+            return None
+        return entry['score'] if entry.get('key') == key else None
+
+    def _store(self, key, score):
+        if self.cache_dir is None:
+            return
+        data = self.cipher.encrypt(json.dumps({'key': key, 'score': score}).encode())
+        _atomic_write(self._path(key), lambda f: f.write(data))
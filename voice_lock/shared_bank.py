@@ -0,0 +1,238 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Reference bank published in shared memory for worker processes.
+
+The bank is packed into one segment: a header, an offset table and all
+template channels as float64. Workers attach to it and get zero-copy
+array views instead of unpickling the templates with every task.
+
+A small control segment holds the name of the current bank segment. It is
+updated under a sequence lock: the publisher makes the sequence odd,
+writes the new name and makes it even again, and readers retry until they
+see the same even sequence before and after reading. So the bank is
+swapped atomically when references are enrolled or removed. The previous
+bank segment is unlinked only when the next one is published, so readers
+that just read its name can still attach to it. Readers that come even
+later re-read the control block and attach to the current bank.
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from .wave_proc import corr_tuple
+
+NAME_SIZE = 64
+CONTROL_SIZE = 16 + NAME_SIZE  # sequence, generation, segment name
+HEADER = 3                     # templates, channels per template, samples
+
+_tracker_owner = None  # process whose resource tracker `_attach` started
+
+def _attach(name):
+    '''Attach to existing segment without handing it to the resource
+    tracker of this process, which would unlink it on exit'''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    # Before Python 3.13 attached segments are always registered. Worker
+    # processes share the tracker of the process that started them, where
+    # the creator's registration is the same entry and must stay. Only a
+    # tracker started by attaching belongs to this process alone
+    global _tracker_owner
+    tracker = resource_tracker._resource_tracker
+    own_tracker = tracker._fd is None or _tracker_owner == os.getpid()
+    shm = shared_memory.SharedMemory(name=name)
+    if own_tracker:
+        _tracker_owner = os.getpid()
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+def _close(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # Caller still holds views, the mapping goes away with the last one
+        pass
+
+def pack_templates(templates):
+    '''Pack template tuples into (offsets, data) arrays'''
+    channels = [np.asarray(channel, dtype=np.float64) for template in templates for channel in template]
+    offsets = np.zeros(len(channels) + 1, dtype=np.int64)
+    np.cumsum([len(channel) for channel in channels], out=offsets[1:])
+    data = np.concatenate(channels) if channels else np.zeros(0)
+    return offsets, data
+
+def _bank_views(buf):
+    '''Template tuples viewing packed bank in `buf`'''
+    count, width, size = np.ndarray(HEADER, dtype=np.int64, buffer=buf)
+    offsets = np.ndarray(count * width + 1, dtype=np.int64, buffer=buf, offset=HEADER * 8)
+    data = np.ndarray(size, dtype=np.float64, buffer=buf, offset=(HEADER + len(offsets)) * 8)
+    data.flags.writeable = False
+    channels = [data[offsets[k]:offsets[k + 1]] for k in range(count * width)]
+    return [tuple(channels[t * width:(t + 1) * width]) for t in range(count)]
+
+class SharedBank(object):
+    '''Publisher of the reference bank. Owns the segments and unlinks them
+    on `close`'''
+
+    def __init__(self, name=None):
+        self.name = name or f'voice_lock_{os.getpid()}'
+        self.generation = 0
+        self.count = 0
+        self._control = shared_memory.SharedMemory(name=self.name, create=True, size=CONTROL_SIZE)
+        self._control.buf[:CONTROL_SIZE] = bytes(CONTROL_SIZE)
+        self._segment = None
+        self._retired = None  # previous segment, kept for readers switching over
+
+    def publish(self, templates):
+        '''Publish new bank contents and switch readers to it'''
+        offsets, data = pack_templates(templates)
+        width = len(templates[0]) if len(templates) else 0
+        size = (HEADER + len(offsets)) * 8 + data.nbytes
+
+        self.generation += 1
+        segment = shared_memory.SharedMemory(name=f'{self.name}_{self.generation}', create=True,
+                                             size=max(size, 1))
+        header = np.ndarray(HEADER, dtype=np.int64, buffer=segment.buf)
+        header[:] = (len(templates), width, len(data))
+        np.ndarray(len(offsets), dtype=np.int64, buffer=segment.buf, offset=HEADER * 8)[:] = offsets
+        np.ndarray(len(data), dtype=np.float64, buffer=segment.buf,
+                   offset=(HEADER + len(offsets)) * 8)[:] = data
+        del header
+
+        # Swap the current segment under the sequence lock
+        control = np.ndarray(2, dtype=np.int64, buffer=self._control.buf)
+        control[0] += 1
+        control[1] = self.generation
+        self._control.buf[16:CONTROL_SIZE] = segment.name.encode().ljust(NAME_SIZE, b'\0')
+        control[0] += 1
+        del control
+
+        # Attached readers keep their mapping until they switch over. The
+        # previous segment stays linked for readers about to attach to it
+        if self._retired is not None:
+            self._retired.close()
+            self._retired.unlink()
+        self._retired, self._segment = self._segment, segment
+        self.count = len(templates)
+
+    def close(self):
+        for shm in (self._retired, self._segment, self._control):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self._retired = self._segment = self._control = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class BankView(object):
+    '''Worker side of `SharedBank`: zero-copy views of the current bank'''
+
+    def __init__(self, name):
+        self._control = _attach(name)
+        self._segment = None
+        self._templates = []
+        self.generation = None
+
+    def _current(self):
+        '''(generation, segment name) read consistently from control block'''
+        control = np.ndarray(2, dtype=np.int64, buffer=self._control.buf)
+        while True:
+            seq = control[0]
+            generation = int(control[1])
+            name = bytes(self._control.buf[16:CONTROL_SIZE]).rstrip(b'\0').decode()
+            if seq % 2 == 0 and control[0] == seq:
+                return generation, name
+            time.sleep(0)
+
+    def templates(self):
+        '''Templates of the current bank, attaching to a newer one if needed'''
+        while True:
+            generation, name = self._current()
+            if generation == self.generation:
+                return self._templates
+            try:
+                segment = _attach(name) if generation else None
+            except FileNotFoundError:
+                continue  # superseded and unlinked meanwhile, read the control block again
+            self._templates = []
+            if self._segment is not None:
+                _close(self._segment)
+            self._segment = segment
+            self._templates = _bank_views(segment.buf) if generation else []
+            self.generation = generation
+
+    def close(self):
+        self._templates = []
+        for shm in (self._segment, self._control):
+            if shm is not None:
+                _close(shm)
+        self._segment = self._control = None
+
+### ~~~ Process pool scoring ~~~ ###
+
+_worker_view = None
+
+def init_worker(name):
+    '''Pool initializer attaching the worker process to bank `name`'''
+    global _worker_view
+    _worker_view = BankView(name)
+
+def worker_view():
+    '''`BankView` of a pool process started with `init_worker`'''
+    return _worker_view
+
+def _score_refs(test_sample, part, parts, metric):
+    '''Scores of every `parts`-th reference starting at `part`, with the
+    generation and size of the bank they come from'''
+    templates = _worker_view.templates()
+    generation = _worker_view.generation
+    scores = [corr_tuple(test_sample, template, metric) for template in templates[part::parts]]
+    return generation, len(templates), scores
+
+class ParallelScorer(object):
+    '''Scores test samples against a `SharedBank` in worker processes.
+    Only the test sample and the share of references are sent with each task'''
+
+    def __init__(self, bank, workers=None, retries=3):
+        self.bank = bank
+        self.workers = workers or os.cpu_count()
+        self.retries = retries
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                        initargs=(bank.name,))
+
+    def score(self, test_sample, metric='minsum'):
+        '''Mean similarity of `test_sample` to the published references.
+        Fails closed with 0.0 when the bank is empty. Scoring is repeated if
+        the bank is swapped while the workers run'''
+        for _ in range(self.retries):
+            futures = [self.pool.submit(_score_refs, test_sample, part, self.workers, metric)
+                       for part in range(self.workers)]
+            results = [future.result() for future in futures]
+            if len({(generation, count) for generation, count, _ in results}) == 1:
+                count = results[0][1]
+                if count == 0:
+                    return 0.0
+                return sum(sum(scores) for _, _, scores in results) / count
+        raise RuntimeError(f'Reference bank kept changing during {self.retries} scoring attempts')
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
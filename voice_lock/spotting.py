@@ -0,0 +1,168 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Passphrase spotting in long recordings.
+
+The block-mean `envelope` separates samples by sign, so its values lose
+their position in time. Spotting uses a time-aligned variant instead: the
+mean positive and mean negated negative sample of every `hop`-sample frame.
+Long recordings are read and denoised block by block, and the reference
+templates are slid across the frames with FFT overlap-save. Memory stays
+bounded by the block size.
+"""
+
+import io
+from collections import namedtuple
+
+import numpy as np
+import scipy.io.wavfile as siw
+
+from .pipeline import DENOISE_PERIOD, Pipeline, denoise
+
+HOP = 150               # samples per envelope frame
+BLOCK_SAMPLES = 45000   # samples per scanning block, multiple of HOP and DENOISE_PERIOD
+SCAN_THRESHOLD = 0.5    # on a synthetic mix the phrase scored 0.68-0.87, impostors 0.40
+
+Match = namedtuple('Match', ['offset', 'score', 'ref_index'])
+
+### ~~~ Time-aligned envelope ~~~ ###
+
+def frame_envelope(wave, hop=HOP):
+    '''Mean positive and mean negated negative sample of each whole frame.
+    Returns array of shape (2, frames)'''
+    frames = wave[:len(wave) - len(wave) % hop].reshape(-1, hop)
+    plus = np.maximum(frames, 0)
+    minus = np.maximum(-frames, 0)
+    return np.stack([plus.sum(1) / np.maximum(np.count_nonzero(plus, 1), 1),
+                     minus.sum(1) / np.maximum(np.count_nonzero(minus, 1), 1)])
+
+def _mono(data, out):
+    '''Samples of `data` averaged over channels, written into `out`, so
+    denoising in place never touches the caller's array'''
+    if data.ndim == 2:
+        return np.mean(data, axis=1, out=out)
+    out[:] = data
+    return out
+
+def stream_envelope(data, block_samples=BLOCK_SAMPLES, hop=HOP):
+    '''Yield frame envelopes of denoised `data` one block at a time'''
+    if block_samples % hop or block_samples % DENOISE_PERIOD:
+        raise ValueError(f'Block size must be a multiple of {hop} and {DENOISE_PERIOD}')
+
+    pipeline = Pipeline()
+    last = float(np.mean(data[-1])) if len(data) else 0.0
+    for start in range(0, len(data), block_samples):
+        block = data[start:start + block_samples]
+        wave = _mono(block, pipeline.buffer('block', len(block)))
+        denoise(wave, pipeline, last=last)
+        last = wave[-1]
+        yield frame_envelope(wave, hop)
+
+def make_scan_template(data, hop=HOP):
+    '''Frame envelope of a whole reference clip'''
+    return np.concatenate(list(stream_envelope(data, hop=hop)), axis=1)
+
+def load_scan_templates(paths, cipher, hop=HOP):
+    '''Scan templates and sample rate of encrypted reference clips'''
+    templates, rates = [], set()
+    for path in paths:
+        rate, data = siw.read(io.BytesIO(cipher.load_data(path)))
+        rates.add(rate)
+        templates.append(make_scan_template(data, hop))
+    if len(rates) > 1:
+        raise ValueError(f'References have different sample rates: {sorted(rates)}')
+    return templates, rates.pop()
+
+### ~~~ Overlap-save scanning ~~~ ###
+
+class _Correlator(object):
+    '''Normalized cross-correlation of one template with a frame stream.
+    Both sides are mean-removed, since envelopes are never negative and
+    would otherwise correlate well with any noise'''
+
+    def __init__(self, template, block_frames):
+        template = template - template.mean(1, keepdims=True)
+        self.length = template.shape[1]
+        self.size = 1 << int(np.ceil(np.log2(block_frames + self.length - 1)))
+        self.spectrum = np.conj(np.fft.rfft(template, self.size))
+        self.norm = np.sqrt(np.sum(template ** 2, axis=1))
+        self.history = np.zeros((2, 0))
+
+    def feed(self, frames):
+        '''Scores of windows starting at each position completed by `frames`'''
+        buf = np.concatenate([self.history, frames], axis=1)
+        self.history = buf[:, max(buf.shape[1] - self.length + 1, 0):]
+        count = buf.shape[1] - self.length + 1
+        if count <= 0:
+            return np.zeros(0)
+
+        # Overlap-save: the first `count` outputs of circular correlation are valid
+        cor = np.fft.irfft(np.fft.rfft(buf, self.size) * self.spectrum, self.size)[:, :count]
+
+        # Window sums give the energy of each mean-removed window
+        sums = np.zeros((2, buf.shape[1] + 1))
+        squares = np.zeros((2, buf.shape[1] + 1))
+        np.cumsum(buf, axis=1, out=sums[:, 1:])
+        np.cumsum(buf ** 2, axis=1, out=squares[:, 1:])
+        total = sums[:, self.length:self.length + count] - sums[:, :count]
+        energy = squares[:, self.length:self.length + count] - squares[:, :count]
+        energy -= total ** 2 / self.length
+        denom = np.sqrt(np.maximum(energy, 0)) * self.norm[:, None]
+        ncc = np.divide(cor, denom, out=np.zeros_like(cor), where=denom > 0)
+        return ncc.mean(0)
+
+def scan(data, templates, threshold, block_samples=BLOCK_SAMPLES, hop=HOP):
+    '''Yield `Match(frame, score, ref_index)` for non-overlapping windows of
+    `data` whose best normalized correlation with a template exceeds
+    `threshold`. Offsets are in frames'''
+    block_frames = block_samples // hop
+    correlators = [_Correlator(template, block_frames) for template in templates]
+    spacing = max(c.length for c in correlators)
+
+    # Shorter templates score window starts earlier than longer ones, so
+    # scores wait here until every template has reached the same start
+    pending = [np.zeros(0) for _ in correlators]
+    state = {'position': 0, 'candidate': None}
+
+    def combine(count):
+        scores = np.full((len(pending), count), -np.inf)
+        for i, s in enumerate(pending):
+            scores[i, :min(len(s), count)] = s[:count]
+            pending[i] = s[count:]
+        best_ref = np.argmax(scores, axis=0)
+        best = scores[best_ref, np.arange(count)]
+
+        for k in np.flatnonzero(best > threshold):
+            frame = state['position'] + k
+            candidate = state['candidate']
+            if candidate is not None and frame - candidate.offset >= spacing:
+                yield candidate
+                candidate = None
+            if candidate is None or best[k] > candidate.score:
+                candidate = Match(int(frame), float(best[k]), int(best_ref[k]))
+            state['candidate'] = candidate
+        state['position'] += count
+
+    for frames in stream_envelope(data, block_samples, hop):
+        for i, c in enumerate(correlators):
+            pending[i] = np.concatenate([pending[i], c.feed(frames)])
+        yield from combine(min(len(s) for s in pending))
+
+    # Window starts near the end are only covered by the shorter templates
+    yield from combine(max(len(s) for s in pending))
+    if state['candidate'] is not None:
+        yield state['candidate']
+
+def spot_file(path, ref_paths, cipher, threshold=SCAN_THRESHOLD, block_samples=BLOCK_SAMPLES,
+              hop=HOP):
+    '''Find the reference phrase in a long WAV file.
+    Returns list of `Match` with offsets in seconds'''
+    templates, ref_rate = load_scan_templates(ref_paths, cipher, hop)
+    rate, data = siw.read(path, mmap=True)
+    if rate != ref_rate:
+        raise ValueError(f'Recording sample rate {rate} differs from references {ref_rate}')
+
+    return [match._replace(offset=match.offset * hop / rate)
+            for match in scan(data, templates, threshold, block_samples, hop)]
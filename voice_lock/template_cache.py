@@ -0,0 +1,162 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Memory-bounded LRU cache of speaker reference templates
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .loader import load_bank
+from .wave_proc import Pyramid, QuantizedChannel, make_enc_wave, make_pyramid
+
+def template_nbytes(template):
+    '''Approximate memory taken by a template tuple'''
+    nbytes = 0
+    for channel in template:
+        if isinstance(channel, Pyramid):
+            nbytes += sum(level.nbytes for level in channel.levels)
+        elif isinstance(channel, (np.ndarray, QuantizedChannel)):
+            nbytes += channel.nbytes
+        else:
+            nbytes += sys.getsizeof(channel) + sum(sys.getsizeof(v) for v in channel)
+    return nbytes
+
+class TemplateCache(object):
+    '''Lazily loads encrypted reference templates and keeps the most recently
+    used ones within `budget` bytes. Templates of pinned speakers are never
+    evicted. Without a custom `loader`, pinning loads all missing templates
+    of a speaker concurrently with `load_bank`.'''
+
+    def __init__(self, cipher, budget=64 * 2**20, loader=None):
+        self.cipher = cipher
+        self.budget = budget
+        self.loader = loader or (lambda path: make_pyramid(make_enc_wave(path, self.cipher)))
+        self.load_many = None if loader else (lambda paths: load_bank(paths, self.cipher))
+
+        self._templates = OrderedDict()  # path -> (template, nbytes), oldest first
+        self._speakers = {}              # speaker -> list of template paths
+        self._pinned = set()             # pinned template paths
+        self._lock = threading.RLock()
+
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # === Speakers ===
+
+    def add_speaker(self, speaker, paths):
+        '''Register template files of `speaker` without loading them'''
+        with self._lock:
+            self._speakers[speaker] = list(paths)
+
+    def remove_speaker(self, speaker):
+        with self._lock:
+            self.unpin(speaker)
+            for path in self._speakers.pop(speaker, []):
+                self._drop(path)
+
+    def speakers(self):
+        return list(self._speakers)
+
+    def templates(self, speaker):
+        '''Lazy sequence of `speaker` templates loaded through the cache'''
+        return SpeakerTemplates(self, self._speakers[speaker])
+
+    def pin(self, speaker):
+        '''Load `speaker` templates and keep them resident'''
+        with self._lock:
+            paths = self._speakers[speaker]
+            self._pinned.update(paths)
+            missing = [path for path in paths if path not in self._templates]
+            if self.load_many is None:
+                for path in paths:
+                    self.get(path)
+                return
+            self.hits += len(paths) - len(missing)
+            self.misses += len(missing)
+
+        # Load the missing ones concurrently, outside the lock
+        if missing:
+            for path, template in zip(missing, self.load_many(missing)):
+                self._put(path, template)
+
+    def unpin(self, speaker):
+        with self._lock:
+            self._pinned.difference_update(self._speakers.get(speaker, []))
+            self._evict()
+
+    # === Templates ===
+
+    def get(self, path):
+        '''Get template stored in `path`, loading it on a miss'''
+        with self._lock:
+            if path in self._templates:
+                self.hits += 1
+                self._templates.move_to_end(path)
+                return self._templates[path][0]
+            self.misses += 1
+
+        # Decrypt and process outside the lock
+        template = self.loader(path)
+        self._put(path, template)
+        return template
+
+    def clear(self):
+        with self._lock:
+            for path in list(self._templates):
+                self._drop(path)
+
+    def stats(self):
+        '''Cache counters and memory usage'''
+        with self._lock:
+            return {'templates': len(self._templates),
+                    'bytes': self.nbytes,
+                    'budget': self.budget,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _put(self, path, template):
+        nbytes = template_nbytes(template)
+        with self._lock:
+            if path not in self._templates:
+                self._templates[path] = (template, nbytes)
+                self.nbytes += nbytes
+            self._evict()
+
+    def _drop(self, path):
+        if path in self._templates:
+            self.nbytes -= self._templates.pop(path)[1]
+
+    def _evict(self):
+        '''Evict least recently used unpinned templates until within budget'''
+        for path in list(self._templates):
+            if self.nbytes <= self.budget:
+                break
+            if path not in self._pinned:
+                self._drop(path)
+                self.evictions += 1
+
+class SpeakerTemplates(object):
+    '''Sequence view of a speaker's templates backed by `TemplateCache`'''
+
+    def __init__(self, cache, paths):
+        self.cache = cache
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        return self.cache.get(self.paths[i])
+
+    def __iter__(self):
+        for path in self.paths:
+            yield self.cache.get(path)
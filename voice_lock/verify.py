@@ -0,0 +1,99 @@
+# Project: Voice Lock
+# Author: Nikolai Gaiduchenko, BSc, MIPT student
+# Verion: 1.0
+
+"""
+Headless verification of a voice sample against the reference bank
+"""
+
+import glob
+import os.path as osp
+
+from .aes_cipher import AESCipher
+from .consolidate import load_consolidation, score_consolidated
+from .loader import load_bank
+from .score_cache import ScoreCache
+from .pipeline import get_envelope_engine
+from .wave_proc import (PIPELINE, corr_tuple, default_threshold, load_quantized, make_enc_wave,
+                        make_wave, quantize, save_quantized)
+
+DATA_DIR = osp.join(osp.abspath(osp.dirname(__file__)), 'data')
+REFS_PATH = osp.join(DATA_DIR, 'ref_samples')
+KEY = b'Sixteen byte key'
+
+def make_cipher(refs_path=REFS_PATH, key=KEY):
+    '''Create AES cipher with the init vector of the reference bank'''
+    cipher = AESCipher(key=key)
+    cipher.load_iv(osp.join(refs_path, 'iv'))
+    return cipher
+
+def find_ref_samples(ref_dir=REFS_PATH):
+    '''Sorted paths of the encrypted reference samples in `ref_dir`'''
+    return sorted(glob.glob(osp.join(ref_dir, '*.wav.enc')))
+
+def load_quantized_ref(path, cipher, bits=16):
+    '''Quantized template of encrypted reference `path`. It is stored
+    encrypted next to the reference and rebuilt when that is newer'''
+    qpath = (f'{path[:-len(".wav.enc")]}.q{bits}v{PIPELINE["version"]}'
+             f'-{get_envelope_engine()}.enc')
+    if osp.exists(qpath) and osp.getmtime(qpath) >= osp.getmtime(path):
+        return load_quantized(qpath, cipher)
+    template = quantize(make_enc_wave(path, cipher), bits)
+    save_quantized(template, qpath, cipher)
+    return template
+
+def load_ref_samples(ref_dir, cipher, quantize_bits=None):
+    '''Load waveform pyramids of all encrypted reference samples in `ref_dir`
+    concurrently, or their quantized templates if `quantize_bits` is 8 or 16'''
+    if quantize_bits is not None:
+        return [load_quantized_ref(sample, cipher, quantize_bits)
+                for sample in find_ref_samples(ref_dir)]
+    return load_bank(find_ref_samples(ref_dir), cipher)
+
+def load_ref_consolidation(ref_samples, cipher, ref_dir=REFS_PATH, quantize_bits=None):
+    '''Medoids of `ref_samples` loaded from `ref_dir`. They are clustered
+    again only when the reference templates changed'''
+    suffix = '' if quantize_bits is None else f'.q{quantize_bits}'
+    name = f'medoids{suffix}-v{PIPELINE["version"]}-{get_envelope_engine()}.enc'
+    return load_consolidation(osp.join(ref_dir, name), ref_samples, cipher)
+
+def score(test_sample, ref_samples, metric='minsum', progress=None, score_cache=None,
+          check=None):
+    '''Mean similarity of `test_sample` to every reference waveform.
+    `progress(i)` is called after the i-th reference is scored. Scores are
+    memoized in `score_cache` if one is given. `check(done)` is called with
+    the fraction of the whole bank done and may raise `Cancelled`'''
+    compare = corr_tuple if score_cache is None else score_cache.score
+    conf = 0
+    for i, ref_sample in enumerate(ref_samples):
+        ref_check = None
+        if check is not None:
+            ref_check = lambda done, i=i: check((i + done) / len(ref_samples))
+        conf += compare(test_sample, ref_sample, metric=metric, check=ref_check)
+        if progress is not None:
+            progress(i + 1)
+    return conf / len(ref_samples)
+
+def verify_file(test_path, ref_dir=REFS_PATH, metric='minsum', threshold=None,
+                score_cache_dir=None, quantize_bits=None, consolidate_refs=False):
+    '''Verify raw .wav file against the reference bank.
+    Returns (confidence, accepted) pair'''
+    if threshold is None:
+        threshold = default_threshold(metric)
+
+    cipher = make_cipher(ref_dir)
+    score_cache = None
+    if score_cache_dir is not None:
+        score_cache = ScoreCache(cache_dir=score_cache_dir, cipher=cipher)
+
+    ref_samples = load_ref_samples(ref_dir, cipher, quantize_bits)
+    test_sample = make_wave(test_path)
+    if quantize_bits is not None:
+        test_sample = quantize(test_sample, quantize_bits)
+    if consolidate_refs:
+        consolidation = load_ref_consolidation(ref_samples, cipher, ref_dir, quantize_bits)
+        conf, _, _ = score_consolidated(test_sample, ref_samples, consolidation, threshold,
+                                        metric, score_cache=score_cache)
+    else:
+        conf = score(test_sample, ref_samples, metric=metric, score_cache=score_cache)
+    return conf, conf > threshold
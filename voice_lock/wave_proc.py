@@ -1,99 +1,229 @@
 import glob
+import hashlib
 import io
+import json
+import os
 import os.path as osp
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import math as m
-import matplotlib.pyplot as plt
 import scipy.io.wavfile as siw
-import sounddevice as sd
+
+from .backends import get_backend
+from . import pipeline as stages
+from .aes_cipher import random_iv
+from .pipeline import default_pipeline, get_envelope_engine, process_batch
 
 ### ~~~ WAV file encryption ~~~ ###
 
+MANIFEST_NAME = 'manifest.json'
+
 def encrypt_wav(file_in, file_out, cipher):
     with open(file_in, 'rb') as f:
         data = f.read()
     cipher.save_data(data, file_out)
 
-def encrypt_wavs(dir_in, dir_out, cipher):
+def file_digest(filename, chunk_size=1 << 16):
+    '''SHA-256 hex digest of a file, read in chunks'''
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _atomic_write(path, write):
+    '''Call `write(f)` on a temporary file next to `path`, then rename it
+    over `path`, so readers never see a half-written file'''
+    fd, tmp_path = tempfile.mkstemp(dir=osp.dirname(path) or '.',
+                                    prefix='.' + osp.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            result = write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if osp.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return result
+
+def encrypt_wav_atomic(file_in, file_out, cipher):
+    '''Stream-encrypt `file_in` into `file_out` through a temporary file,
+    under a fresh init vector stored at the start of the output. Returns
+    the number of plaintext bytes written'''
+    def write(f_out):
+        with open(file_in, 'rb') as f_in:
+            return cipher.encrypt_stream(f_in, f_out, iv=random_iv())
+    return _atomic_write(file_out, write)
+
+def load_manifest(dir_out):
+    '''Load the encryption manifest of `dir_out` (empty if there is none)'''
+    path = osp.join(dir_out, MANIFEST_NAME)
+    if not osp.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def encrypt_wavs(dir_in, dir_out, cipher, incremental=False, workers=None):
     '''Use this code to encrypt sapltes from the `dir_in` using `cipher`
-    and store them in `dir_out`'''
-
-    # Save new init vector for decoding
-    cipher.save_iv(osp.join(dir_out, 'iv'))
+    and store them in `dir_out`.
+
+    Every sample is encrypted under its own init vector. With
+    `incremental=True` samples whose content hash matches the manifest are
+    skipped, and the directory keeps the init vector stored in `dir_out`.
+    Changed samples are encrypted concurrently by `workers` threads.
+    Returns a report dict with file counts, bytes and throughput.'''
+    start = time.perf_counter()
+    iv_path = osp.join(dir_out, 'iv')
+    key_id = hashlib.sha256(cipher.key).hexdigest()
+
+    manifest = load_manifest(dir_out) if incremental else {}
+    if manifest.get('key_id') != key_id:
+        manifest = {}
+    if incremental and osp.exists(iv_path):
+        # The directory's init vector is what `make_cipher` loads for other
+        # encrypted files, so it stays the same
+        cipher.load_iv(iv_path)
 
     # Find saplte paths
-    sapltes = glob.glob(osp.join(dir_in, '*.wav'))
+    sapltes = sorted(glob.glob(osp.join(dir_in, '*.wav')))
 
-    # Ecntypt and store each saplte
+    # Skip samples that did not change since the last run
+    old_files = manifest.get('files', {})
+    files, todo = {}, []
     for saplte in sapltes:
         basename = osp.basename(saplte) + '.enc'
-        encrypt_wav(file_in=saplte, file_out=osp.join(dir_out, basename), cipher=cipher)
+        digest = file_digest(saplte)
+        files[basename] = digest
+        if old_files.get(basename) != digest or not osp.exists(osp.join(dir_out, basename)):
+            todo.append((saplte, osp.join(dir_out, basename)))
+
+    # Ecntypt and store each changed saplte
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        nbytes = sum(pool.map(lambda paths: encrypt_wav_atomic(*paths, cipher=cipher), todo))
+
+    # Every output starts with its own init vector. The directory's one and
+    # the manifest are only written once all outputs are in place
+    _atomic_write(iv_path, lambda f: f.write(cipher.iv))
+    manifest = {'key_id': key_id, 'files': files}
+    _atomic_write(osp.join(dir_out, MANIFEST_NAME),
+                  lambda f: f.write(json.dumps(manifest, indent=2).encode()))
+
+    seconds = time.perf_counter() - start
+    return {'total': len(sapltes),
+            'encrypted': len(todo),
+            'skipped': len(sapltes) - len(todo),
+            'bytes': nbytes,
+            'seconds': seconds,
+            'mb_per_s': nbytes / 2**20 / seconds if seconds > 0 else 0.0}
 
 ### ~~~ Waveform loading ~~~ ###
 
 def get_enc_wav_data(filename, cipher):
-    '''Get data from encrypted WAV file'''
+    '''Get data from encrypted WAV file, stereo averaged to mono'''
+    data = read_enc_wav(filename, cipher)
+    return data.mean(1) if data.ndim == 2 else data
 
-    # Get encrypted binary data
-    data_raw = cipher.load_data(filename)
-
-    # Read decrypted binary data as normal WAV file w/o saving it
-    sample_rate, data_np = siw.read(io.BytesIO(data_raw))
+def get_wave_data(wave_filename):
+    '''Get data from raw WAV file, stereo averaged to mono'''
+    data = read_wav(wave_filename)
+    return data.mean(1) if data.ndim == 2 else data
 
-    # Get rid of stereo by estimating the mean for both channels
-    if isinstance(data_np[0], np.ndarray):
-        data_np = data_np.mean(1)
+def read_enc_wav(filename, cipher):
+    '''Get samples from encrypted WAV file as stored, without mixdown'''
+    return siw.read(io.BytesIO(cipher.load_data(filename)))[1]
 
-    return data_np
+def read_wav(filename):
+    '''Get samples from raw WAV file as stored, without mixdown'''
+    return siw.read(filename)[1]
 
-def get_wave_data(wave_filename):
-    '''Get data from raw WAV file'''
-    sample_rate, wave_data = siw.read(wave_filename)
-    if isinstance(wave_data[0], np.ndarray): # стерео
-        wave_data = wave_data.mean(1)
-    return wave_data
-
-def make_enc_wave(filename, cipher):
+def make_enc_wave(filename, cipher, pipeline=None):
     '''Create appropriate waveform from encrypted .wav file'''
-    return envelope(denoise(normalize(get_enc_wav_data(filename, cipher))))
+    return (pipeline or default_pipeline())(read_enc_wav(filename, cipher))
 
-def make_wave(filename):
+def make_wave(filename, pipeline=None):
     '''Create appropriate waveform from raw .wav file'''
-    return envelope(denoise(normalize(get_wave_data(filename))))
+    return (pipeline or default_pipeline())(read_wav(filename))
+
+BATCH_SIZE = 64  # most clips preprocessed together by `make_waves`
+BATCH_SAMPLES = 1 << 18  # most padded samples in a batch, to stay in cache
+
+def _make_batches(read, filenames, pipeline, batch_size, max_samples):
+    # Clips of similar file size go together, so rows need little padding
+    order = sorted(range(len(filenames)), key=lambda k: osp.getsize(filenames[k]))
+    templates = [None] * len(filenames)
+    chunk, clips = [], []
+
+    def flush():
+        for k, template in zip(chunk, process_batch(clips, pipeline)):
+            templates[k] = template
+        chunk.clear()
+        clips.clear()
+
+    for k in order:
+        data = read(filenames[k])
+        width = max([len(data)] + [len(clip) for clip in clips])
+        if clips and (len(clips) == batch_size or (len(clips) + 1) * width > max_samples):
+            flush()
+        chunk.append(k)
+        clips.append(data)
+    if clips:
+        flush()
+    return templates
+
+def make_waves(filenames, pipeline=None, batch_size=BATCH_SIZE, max_samples=BATCH_SAMPLES):
+    '''Create waveforms from many raw .wav files, preprocessed in batches
+    of at most `batch_size` clips and `max_samples` padded samples'''
+    return _make_batches(read_wav, list(filenames), pipeline, batch_size, max_samples)
+
+def make_enc_waves(filenames, cipher, pipeline=None, batch_size=BATCH_SIZE,
+                   max_samples=BATCH_SAMPLES):
+    '''Create waveforms from many encrypted .wav files, preprocessed in batches'''
+    return _make_batches(lambda filename: read_enc_wav(filename, cipher), list(filenames),
+                         pipeline, batch_size, max_samples)
 
 ### ~~~ Waveform processing ~~~ ###
 
+# Settings of the preprocessing pipeline. Bump `version` whenever the
+# processing changes so that cached results derived from it are invalidated.
+# The stages themselves live in `pipeline`.
+PIPELINE = {
+    'version': 2,
+    'normalize': 'peak',
+    'denoise': 'preemphasis-0.9-hamming-180',
+    'envelope_block': 75,
+}
+
+# Single preprocessing steps, run by the stages of the calling thread's
+# default pipeline
+
 def normalize(wave_data):
-    return wave_data / np.amax(wave_data)
+    '''Peak-normalized copy of `wave_data`'''
+    return stages.normalize(np.array(wave_data, dtype=np.float64), default_pipeline())
 
 def denoise(wave_data):
-    for i in range(len(wave_data)):
-        wave_data[i] = (wave_data[i]-0.9*wave_data[i-1])*(0.54-0.46*m.cos((i-6)*2*m.pi/180))
-    return wave_data
-
-def envelope(wave):
-    '''Get signal envelope'''
-    plus=[]
-    minus=[]
-    a=[]
-    b=[]
-    for elm in wave:
-        if elm>=0:
-            plus.append(elm)
-        else:
-            minus.append(abs(elm))
+    '''Denoise float array `wave_data` in place'''
+    return stages.denoise(wave_data, default_pipeline())
+
+def envelope(wave, block=75):
+    '''Get signal envelope averaged over `block` samples'''
+    return stages.envelope(np.asarray(wave, dtype=np.float64), default_pipeline(), block)
 
-    for i in range(0, (len(plus) - len(plus)%75), 75):
-        a.append(np.mean(plus[i:i+75]))
-    for i in range(0, (len(minus)-len(minus)%75), 75):
-        b.append(np.mean(minus[i:i+75]))
-    return (a, b)
+class Cancelled(Exception):
+    '''Raised by a `check` callback to abort a comparison'''
 
-def corr(wave1, wave2):
+# Similarity functions accept optional `check(done)` callback. It is called
+# regularly with the fraction of work done and may raise `Cancelled`.
 
-    wave1 = np.asarray(wave1)
-    wave2 = np.asarray(wave2)
+CORR_CHUNK = 64  # rows of `corr` computed between `check` calls
+
+def corr(wave1, wave2, check=None, backend=None):
+
+    wave1 = np.asarray(wave1, dtype=np.float64)
+    wave2 = np.asarray(wave2, dtype=np.float64)
 
     # make waves of the same array size by zero padding
     f = abs(len(wave1) - len(wave2))
@@ -104,28 +234,364 @@ def corr(wave1, wave2):
 
     cor=np.zeros(2 * len(wave1) + 1)
     wave=np.zeros(3 * len(wave1))
-    for i in range(len(wave1)):
-        wave[i+len(wave1)]=wave1[i] # duplicate wave1 3 times and store in wave
+    wave[len(wave1):2 * len(wave1)] = wave1 # duplicate wave1 3 times and store in wave
 
-    for i in range(2 * len(wave1) + 1):
-        for j in range(len(wave2)):
-            cor[i] += min(wave2[j], wave[i + j])
+    # The min-sum of every row is computed by the selected backend
+    rows = 2 * len(wave1) + 1
+    kernel = get_backend(backend)
+    for start in range(0, rows, CORR_CHUNK):
+        if check is not None:
+            check(start / rows)
+        stop = min(start + CORR_CHUNK, rows)
+        cor[start:stop] = kernel(wave, wave2, start, stop)
 
     mxx1 = np.sum(wave1)
     mxx2 = np.sum(wave2)
 
     return np.max(cor) / max(mxx1, mxx2)
 
-def corr_tuple(tup1,tup2):
-    return (corr(tup1[0], tup2[0]) + corr(tup1[1], tup2[1])) / 2
+def _seed_row(wave1, wave2, seed):
+    '''`corr` row aligning the energy centroids of the waves, or zero lag'''
+    n = len(wave1)
+    mass1, mass2 = wave1.sum(), wave2.sum()
+    if seed == 'zero' or mass1 <= 0 or mass2 <= 0:
+        return n
+    if seed != 'centroid':
+        raise ValueError(f"Unknown seed {seed!r}, expected 'centroid' or 'zero'")
+    positions = np.arange(n)
+    lag = np.dot(positions, wave1) / mass1 - np.dot(positions, wave2) / mass2
+    return int(np.clip(n + round(lag), 0, 2 * n))
+
+def corr_pruned(wave1, wave2, check=None, backend=None, seed='centroid', block=CORR_CHUNK,
+                stats=None):
+    '''Same score as `corr`, skipping shifts that cannot reach the maximum.
+
+    The min-sum of a shift is at most the smaller of the sums of either
+    wave over the overlap. Rows of `corr` are scored in blocks of `block`,
+    starting from the `seed` alignment ('centroid' or 'zero' lag) and then
+    in order of decreasing bound. Rows whose bound is below the best score
+    so far are never computed. If `stats` dict is given, the numbers of
+    shifts and of pruned shifts are added to it.'''
+    wave1 = np.asarray(wave1, dtype=np.float64)
+    wave2 = np.asarray(wave2, dtype=np.float64)
+
+    f = abs(len(wave1) - len(wave2))
+    if len(wave1) < len(wave2):
+        wave1 = np.pad(wave1, pad_width=(0, f), mode='constant')
+    elif len(wave1) > len(wave2):
+        wave2 = np.pad(wave2, pad_width=(0, f), mode='constant')
+
+    n = len(wave1)
+    wave = np.zeros(3 * n)
+    wave[n:2 * n] = wave1
+
+    # Row i matches wave2[j] against wave1[j + i - n] where both exist
+    rows = 2 * n + 1
+    shift = np.arange(rows) - n
+    lo = np.clip(-shift, 0, n)
+    hi = np.clip(n - shift, 0, n)
+    sums1 = np.concatenate(([0.0], np.cumsum(wave1)))
+    sums2 = np.concatenate(([0.0], np.cumsum(wave2)))
+    bound = np.minimum(sums2[hi] - sums2[lo],
+                       sums1[np.clip(hi + shift, 0, n)] - sums1[np.clip(lo + shift, 0, n)])
+    # Keep shifts that could tie the best up to rounding of the sums
+    tol = 1e-9 * (np.abs(wave1).sum() + np.abs(wave2).sum()) + 1e-12
+
+    starts = np.arange(0, rows, block)
+    block_bound = np.maximum.reduceat(bound, starts)
+    first = _seed_row(wave1, wave2, seed) // block
+    order = [first] + [b for b in np.argsort(-block_bound, kind='stable') if b != first]
+
+    kernel = get_backend(backend)
+    best = -np.inf
+    done = 0
+    for b in order:
+        if block_bound[b] + tol < best:
+            break  # blocks come in decreasing bound order from here on
+        if check is not None:
+            check(done / rows)
+        start, stop = starts[b], min(starts[b] + block, rows)
+        live = np.flatnonzero(bound[start:stop] + tol >= best)
+        start, stop = start + live[0], start + live[-1] + 1
+        best = max(best, kernel(wave, wave2, start, stop).max())
+        done += stop - start
+
+    if stats is not None:
+        stats['shifts'] = stats.get('shifts', 0) + rows
+        stats['pruned'] = stats.get('pruned', 0) + rows - done
+    return best / max(np.sum(wave1), np.sum(wave2))
+
+def corr_fft(wave1, wave2, check=None):
+    '''Peak of the normalized cross-correlation of two envelopes over all
+    shifts, computed via FFT in O(n log n)'''
+    if check is not None:
+        check(0)
+    from scipy.signal import fftconvolve  # slow import, load on first use
+
+    wave1 = np.asarray(wave1, dtype=np.float64)
+    wave2 = np.asarray(wave2, dtype=np.float64)
+
+    norm = np.sqrt(np.dot(wave1, wave1) * np.dot(wave2, wave2))
+    if norm == 0:
+        return 0.0
+
+    cor = fftconvolve(wave1, wave2[::-1], mode='full')
+    return np.max(cor) / norm
+
+### ~~~ Coarse-to-fine alignment ~~~ ###
+
+PYRAMID_BLOCKS = (75, 300, 1200)
+
+class Pyramid(object):
+    '''Envelope channel at several block resolutions, finest first.
+
+    Coarser levels average groups of finer blocks, which equals the envelope
+    taken with the larger block directly. Acts as its finest level array
+    for the other metrics.'''
+
+    def __init__(self, wave, blocks=PYRAMID_BLOCKS):
+        self.blocks = tuple(blocks)
+        self.levels = [np.asarray(wave, dtype=np.float64)]
+        for block, coarse_block in zip(self.blocks, self.blocks[1:]):
+            factor = coarse_block // block
+            level = self.levels[-1]
+            level = level[:len(level) - len(level) % factor]
+            self.levels.append(level.reshape(-1, factor).mean(1))
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def __getitem__(self, i):
+        return self.levels[0][i]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.levels[0], dtype=dtype)
+
+def make_pyramid(wave_tuple, blocks=PYRAMID_BLOCKS):
+    '''Build envelope pyramid for every channel of a waveform tuple'''
+    return tuple(Pyramid(wave, blocks) for wave in wave_tuple)
+
+def minsum_at(wave1, wave2, lags):
+    '''Min-sum of `wave2` against `wave1` shifted by each lag in `lags`.
+    For non-negative envelopes this equals the `corr` accumulator'''
+    cor = np.zeros(len(lags))
+    for k, lag in enumerate(lags):
+        lo = max(0, -lag)
+        hi = min(len(wave2), len(wave1) - lag)
+        if hi > lo:
+            cor[k] = np.minimum(wave2[lo:hi], wave1[lo + lag:hi + lag]).sum()
+    return cor
+
+def _overlap(n1, n2, lags):
+    '''Number of overlapping samples for each lag'''
+    lags = np.asarray(lags)
+    return np.maximum(0, np.minimum(n2, n1 - lags) - np.maximum(0, -lags))
+
+def corr_pyramid(wave1, wave2, candidates=10, radius=1, stats=None, check=None):
+    '''Approximate `corr` by coarse-to-fine search of the best shift.
+
+    All shifts are scored at the coarsest level, then only `radius`
+    neighbourhoods of the best `candidates` lags are refined at each finer
+    level. If `stats` dict is given, the numbers of element comparisons
+    done and needed by the exhaustive search are added to it.'''
+    if not isinstance(wave1, Pyramid):
+        wave1 = Pyramid(wave1)
+    if not isinstance(wave2, Pyramid):
+        wave2 = Pyramid(wave2, wave1.blocks)
+
+    levels = [(level1, level2, block)
+              for level1, level2, block in zip(wave1.levels, wave2.levels, wave1.blocks)
+              if len(level1) and len(level2)]
+    if not levels:
+        return 0.0
+
+    work = 0
+    lags = None
+    for depth, (level1, level2, block) in enumerate(reversed(levels)):
+        if check is not None:
+            check(depth / len(levels))
+        n1, n2 = len(level1), len(level2)
+        if lags is None:
+            lags = np.arange(-n2 + 1, n1)
+        else:
+            # Map the best coarse lags to the neighbourhood on this level
+            factor = prev_block // block
+            span = np.arange(-factor - radius, factor + radius + 1)
+            lags = np.unique((best[:, None] * factor + span).ravel())
+            lags = lags[(lags > -n2) & (lags < n1)]
+
+        cor = minsum_at(level1, level2, lags)
+        work += _overlap(n1, n2, lags).sum()
+        best = lags[np.argsort(cor)[::-1][:candidates]]
+        prev_block = block
+
+    if stats is not None:
+        stats['comparisons'] = stats.get('comparisons', 0) + int(work)
+        stats['exhaustive'] = stats.get('exhaustive', 0) + len(wave1) * len(wave2)
+
+    mxx = max(np.sum(wave1.levels[0]), np.sum(wave2.levels[0]))
+    return np.max(cor) / mxx
+
+### ~~~ Quantized templates ~~~ ###
+
+QUANT_DTYPES = {8: np.uint8, 16: np.uint16}
+QUANT_SCALE_BITS = 16  # precision of the scale ratio when scales differ
+
+class QuantizedChannel(object):
+    '''Envelope channel stored as unsigned integers times `scale`.
+    Both channels of a template share one scale. Acts as the dequantized
+    float array for the other metrics.'''
+
+    def __init__(self, values, scale):
+        self.values = values
+        self.scale = float(scale)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i] * self.scale
+
+    def __array__(self, dtype=None, copy=None):
+        return np.multiply(self.values, self.scale, dtype=dtype or np.float64)
+
+def quantize(wave_tuple, bits=16):
+    '''Quantize waveform tuple to `bits`-bit unsigned channels with a common
+    scale, so the largest value maps to the top of the range'''
+    dtype = QUANT_DTYPES[bits]
+    channels = [np.asarray(wave, dtype=np.float64) for wave in wave_tuple]
+    peak = max((channel.max() for channel in channels if len(channel)), default=0)
+    scale = peak / np.iinfo(dtype).max if peak > 0 else 1.0
+    return tuple(QuantizedChannel(np.rint(channel / scale).astype(dtype), scale)
+                 for channel in channels)
+
+def save_quantized(wave_tuple, filename, cipher):
+    '''Store quantized template encrypted in `filename`'''
+    buf = io.BytesIO()
+    np.savez(buf, *[channel.values for channel in wave_tuple], scale=wave_tuple[0].scale)
+    data = cipher.encrypt(buf.getvalue())
+    _atomic_write(filename, lambda f: f.write(data))
+
+def load_quantized(filename, cipher):
+    '''Load quantized template stored by `save_quantized`'''
+    with np.load(io.BytesIO(cipher.load_data(filename)), allow_pickle=False) as data:
+        scale = float(data['scale'])
+        count = len(data.files) - 1
+        return tuple(QuantizedChannel(data[f'arr_{k}'], scale) for k in range(count))
+
+def minsum_max(wave1, wave2, check=None, chunk=256):
+    '''Largest min-sum of `wave2` against `wave1` over all overlapping
+    shifts, i.e. the peak of the `corr` accumulator. Works in the dtype of
+    the inputs, so integer channels are compared as integers'''
+    n1, n2 = len(wave1), len(wave2)
+    if n1 == 0 or n2 == 0:
+        return 0
+    acc = np.int64 if np.issubdtype(wave1.dtype, np.integer) else np.float64
+
+    # Row k of `windows` is wave1 shifted by k - n2 + 1 under wave2
+    padded = np.zeros(n1 + 2 * (n2 - 1), dtype=wave1.dtype)
+    padded[n2 - 1:n2 - 1 + n1] = wave1
+    windows = np.lib.stride_tricks.sliding_window_view(padded, n2)
+
+    best = 0
+    for start in range(0, len(windows), chunk):
+        if check is not None:
+            check(start / len(windows))
+        best = max(best, np.minimum(windows[start:start + chunk], wave2).sum(1, dtype=acc).max())
+    return best
+
+def corr_quantized(wave1, wave2, check=None):
+    '''`corr` of quantized channels computed in the integer domain.
+    Float channels are quantized to 16 bits first'''
+    if not isinstance(wave1, QuantizedChannel):
+        wave1 = quantize((wave1,))[0]
+    if not isinstance(wave2, QuantizedChannel):
+        wave2 = quantize((wave2,))[0]
+
+    values1, values2 = wave1.values, wave2.values
+    if wave1.scale != wave2.scale:
+        # Bring both channels to the larger scale with a fixed-point ratio
+        top = max(wave1.scale, wave2.scale)
+        one = 1 << QUANT_SCALE_BITS
+        values1 = values1.astype(np.uint32) * np.uint32(round(one * wave1.scale / top))
+        values2 = values2.astype(np.uint32) * np.uint32(round(one * wave2.scale / top))
+
+    mxx = max(values1.sum(dtype=np.int64), values2.sum(dtype=np.int64))
+    if mxx == 0:
+        return 0.0
+    return minsum_max(values1, values2, check=check) / mxx
+
+# Similarity metrics selectable by name
+METRICS = {
+    'minsum': corr,
+    'ncc': corr_fft,
+    'pyramid': corr_pyramid,
+    'minsum-int': corr_quantized,
+    'minsum-pruned': corr_pruned,
+}
+
+# Default cut-off thresholds for each metric. The 'ncc' one is picked at the
+# EER point on the bundled samples (see `python -m voice_lock.bench metrics`)
+THRESHOLDS = {
+    'minsum': 0.6,
+    'ncc': 0.675,
+    'pyramid': 0.6,
+    'minsum-int': 0.6,
+    'minsum-pruned': 0.6,
+}
+
+# Hilbert envelopes score on another scale. Thresholds at the EER point on
+# the bundled samples (see `python -m voice_lock.bench envelopes`)
+HILBERT_THRESHOLDS = {
+    'minsum': 0.517,
+    'ncc': 0.703,
+    'pyramid': 0.517,
+    'minsum-int': 0.517,
+    'minsum-pruned': 0.517,
+}
+
+def default_threshold(metric, engine=None):
+    '''Default cut-off of `metric` for templates of envelope `engine`,
+    the engine of the default pipeline if None'''
+    engine = engine or get_envelope_engine()
+    return (HILBERT_THRESHOLDS if engine == 'hilbert' else THRESHOLDS)[metric]
+
+def get_metric(metric):
+    '''Get similarity function by metric name'''
+    try:
+        return METRICS[metric]
+    except KeyError:
+        raise ValueError(f'Unknown metric {metric!r}, expected one of {sorted(METRICS)}')
+
+def corr_tuple(tup1, tup2, metric='minsum', check=None, **params):
+    '''Mean similarity of the channels of two templates. Block envelopes
+    have two channels, Hilbert envelopes one'''
+    sim = get_metric(metric)
+    if len(tup1) != len(tup2):
+        raise ValueError(f'Templates have {len(tup1)} and {len(tup2)} channels, '
+                         'they come from different envelope engines')
+
+    def channel_check(channel):
+        if check is None:
+            return None
+        return lambda done: check((channel + done) / len(tup1))
+
+    return sum(sim(wave1, wave2, check=channel_check(channel), **params)
+               for channel, (wave1, wave2) in enumerate(zip(tup1, tup2))) / len(tup1)
 
 
 ### ~~~ Plotting ~~~ ###
 
 def plot_waveform(wave_data):
-    if len(wave_data) == 2:
-        plt.plot(np.arange(len(wave_data[0])), wave_data[0])
-        plt.plot(np.arange(len(wave_data[1])), wave_data[1])
+    import matplotlib.pyplot as plt
+
+    if isinstance(wave_data, tuple):  # envelope channels
+        for channel in wave_data:
+            plt.plot(np.arange(len(channel)), channel)
 
     else:
         plt.plot(np.arange(len(wave_data)), wave_data)